@@ -0,0 +1,169 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- LINE Messaging API のローカルスタブ ---
+# push / multicast / reply / profile を受け付け、遅延と 429(レート制限) を任意の割合で注入する。
+# 使い方: python benchmarks/line_stub.py --port 8181 --latency-ms 50 --rate-limit-ratio 0.01
+#         LINE_API_ENDPOINT=http://127.0.0.1:8181 を設定してアプリやバッチを起動する。
+PROFILE_PATH = re.compile(r'^/v2/bot/profile/(?P<user_id>[^/?]+)$')
+POST_ENDPOINTS = {
+    '/v2/bot/message/push': 'push',
+    '/v2/bot/message/multicast': 'multicast',
+    '/v2/bot/message/reply': 'reply',
+}
+
+
+class StubState:
+    def __init__(self, latency_ms=0, jitter_ms=0, rate_limit_ratio=0.0, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_limit_ratio = rate_limit_ratio
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.rate_limited = Counter()
+        self.recipients = Counter()
+
+    def delay(self):
+        latency = self.latency_ms + (self.random.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0)
+        if latency > 0:
+            time.sleep(latency / 1000)
+
+    def should_rate_limit(self):
+        with self.lock:
+            return self.rate_limit_ratio > 0 and self.random.random() < self.rate_limit_ratio
+
+    def record(self, name, recipients=0, rate_limited=False):
+        with self.lock:
+            self.calls[name] += 1
+            self.recipients[name] += recipients
+            if rate_limited:
+                self.rate_limited[name] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'calls': dict(self.calls),
+                'rate_limited': dict(self.rate_limited),
+                'recipients': dict(self.recipients),
+            }
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+            self.rate_limited.clear()
+            self.recipients.clear()
+
+
+def make_handler(state):
+    class LineStubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status, payload, headers=None):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _rate_limited(self, name, recipients=0):
+            if not state.should_rate_limit():
+                return False
+            state.record(name, recipients, rate_limited=True)
+            self._send_json(429, {'message': 'The API rate limit has been exceeded. Try again later.'})
+            return True
+
+        def do_GET(self):
+            if self.path == '/__stats':
+                self._send_json(200, state.snapshot())
+                return
+            match = PROFILE_PATH.match(self.path)
+            if not match:
+                self._send_json(404, {'message': 'Not found'})
+                return
+            state.delay()
+            if self._rate_limited('profile'):
+                return
+            state.record('profile', 1)
+            user_id = match.group('user_id')
+            self._send_json(200, {
+                'userId': user_id,
+                'displayName': f'ベンチ{user_id[-6:]}',
+                'pictureUrl': 'https://example.com/profile.png',
+                'statusMessage': '',
+            })
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            raw = self.rfile.read(length) if length else b''
+            if self.path == '/__reset':
+                state.reset()
+                self._send_json(200, {})
+                return
+            name = POST_ENDPOINTS.get(self.path)
+            if not name:
+                self._send_json(404, {'message': 'Not found'})
+                return
+            try:
+                payload = json.loads(raw or b'{}')
+            except json.JSONDecodeError:
+                self._send_json(400, {'message': 'The request body has 1 error(s)'})
+                return
+            to = payload.get('to')
+            recipients = len(to) if isinstance(to, list) else 1
+            state.delay()
+            if self._rate_limited(name, recipients):
+                return
+            state.record(name, recipients)
+            self._send_json(200, {'sentMessages': []}, {'X-Line-Request-Id': f'stub-{time.time_ns()}'})
+
+    return LineStubHandler
+
+
+def start_stub(host='127.0.0.1', port=0, **options):
+    state = StubState(**options)
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    endpoint = f'http://{host}:{server.server_address[1]}'
+    return server, state, endpoint
+
+
+def main():
+    parser = argparse.ArgumentParser(description='LINE Messaging API のローカルスタブ')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8181)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0, help='429 を返す割合 (0.0〜1.0)')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    server, state, endpoint = start_stub(
+        args.host, args.port,
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+        rate_limit_ratio=args.rate_limit_ratio, seed=args.seed
+    )
+    print(f"LINE APIスタブを起動しました: {endpoint} （Ctrl+C で終了）")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
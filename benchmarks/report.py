@@ -0,0 +1,68 @@
+import json
+import math
+import os
+
+# --- ベンチマーク結果の集計（p50/p95/p99）とベースライン比較 ---
+DEFAULT_TOLERANCE = 0.2
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    # nearest-rank 法
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(latencies_seconds, extra=None):
+    values = sorted(latencies_seconds)
+    summary = {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 50) * 1000, 2),
+        'p95_ms': round(percentile(values, 95) * 1000, 2),
+        'p99_ms': round(percentile(values, 99) * 1000, 2),
+        'max_ms': round(values[-1] * 1000, 2) if values else 0.0,
+    }
+    if extra:
+        summary.update(extra)
+    return summary
+
+
+def print_table(results):
+    print(f"{'シナリオ':<24}{'件数':>8}{'p50(ms)':>12}{'p95(ms)':>12}{'p99(ms)':>12}{'max(ms)':>12}")
+    for name, summary in results.items():
+        print(f"{name:<28}{summary['count']:>8}{summary['p50_ms']:>12.2f}{summary['p95_ms']:>12.2f}{summary['p99_ms']:>12.2f}{summary['max_ms']:>12.2f}")
+
+
+def load_baseline(path):
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_results(path, results, meta=None):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'meta': meta or {}, 'results': results}, f, ensure_ascii=False, indent=2)
+        f.write('\n')
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    # p95 がベースラインより tolerance 以上悪化したシナリオを回帰として返す
+    regressions = []
+    baseline_results = (baseline or {}).get('results', {})
+    print(f"\n--- ベースラインとの比較（許容 +{tolerance:.0%}）---")
+    for name, summary in results.items():
+        base = baseline_results.get(name)
+        if not base:
+            print(f"{name:<28} ベースラインなし")
+            continue
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            before, after = base[key], summary[key]
+            change = (after - before) / before if before else 0.0
+            marker = ''
+            if key == 'p95_ms' and change > tolerance:
+                marker = '  <-- 回帰'
+                regressions.append(name)
+            print(f"{name:<28}{key:>8} {before:>10.2f} -> {after:>10.2f} ({change:+.1%}){marker}")
+    return regressions
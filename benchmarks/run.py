@@ -0,0 +1,238 @@
+import argparse
+import base64
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from line_stub import start_stub
+from report import summarize, print_table, load_baseline, save_results, compare, DEFAULT_TOLERANCE
+from webhook_load import PayloadGenerator, run_load
+
+# --- ベンチマークの実行 ---
+# LINE APIスタブを起動し、投入データに対して各シナリオをアプリ内（Flaskのテストクライアント）で計測する。
+# 使い方: python benchmarks/run.py --users 2000 --scenarios webhook,admin_chat,send_fanout
+#         アプリの DATABASE_URL は読まず、一時ディレクトリの SQLite を使う。別のDB（PostgreSQL など）で計測する場合は
+#         BENCH_DATABASE_URL を指定する。そのDBにデータがある場合は --reset を付けた時だけ削除して投入し直す。
+ADMIN_USERNAME = 'bench'
+ADMIN_PASSWORD = 'bench'
+CHANNEL_SECRET = 'bench-channel-secret'
+ALL_SCENARIOS = ['webhook', 'admin_chat', 'admin_friends', 'send_fanout', 'send_fanout_personalized', 'batch_cycle']
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+
+
+def prepare_environment(args):
+    from seed import use_bench_database
+    if not use_bench_database():
+        db_path = os.path.join(tempfile.mkdtemp(prefix='linebot-bench-'), 'bench.db')
+        os.environ['DATABASE_URL'] = f'sqlite:///{db_path}'
+    # Webとバッチを1プロセスで動かすので、プロセス内キャッシュで無効化が足りる
+    os.environ.setdefault('CACHE_BACKEND', 'local')
+    os.environ['ADMIN_USERNAME'] = ADMIN_USERNAME
+    os.environ['ADMIN_PASSWORD'] = ADMIN_PASSWORD
+    server, stub_state, endpoint = start_stub(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, rate_limit_ratio=args.rate_limit_ratio, seed=1
+    )
+    os.environ['LINE_API_ENDPOINT'] = endpoint
+    return server, stub_state
+
+
+def configure_credentials():
+    from core import Session, Setting
+    session = Session()
+    for key, value in (('line_channel_access_token', 'bench-token'), ('line_channel_secret', CHANNEL_SECRET)):
+        setting = session.query(Setting).filter_by(key=key).first() or Setting(key=key)
+        setting.value = value
+        session.add(setting)
+    session.commit()
+    Session.remove()
+
+
+def auth_headers():
+    token = base64.b64encode(f'{ADMIN_USERNAME}:{ADMIN_PASSWORD}'.encode()).decode()
+    return {'Authorization': f'Basic {token}'}
+
+
+def timed_requests(client, method, path, iterations, **kwargs):
+    latencies = []
+    statuses = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        response = getattr(client, method)(path, headers=auth_headers(), **kwargs)
+        latencies.append(time.perf_counter() - started)
+        statuses.append(response.status_code)
+    return latencies, statuses
+
+
+def scenario_webhook(app, args, stub_state):
+    from seed import user_id_for
+    user_ids = [user_id_for(i) for i in range(args.users)]
+    generator = PayloadGenerator(user_ids, follow_ratio=0.1, seed=7)
+
+    def send(body, signature):
+        # テストクライアントはスレッド間で共有しない
+        client = app.test_client()
+        response = client.post('/callback', data=body, headers={
+            'Content-Type': 'application/json', 'X-Line-Signature': signature
+        })
+        return response.status_code
+
+    result = run_load(send, generator.next_body, CHANNEL_SECRET, args.webhook_rate,
+                      total=args.webhook_requests, concurrency=args.concurrency)
+    throughput = len(result['latencies']) / result['wall_seconds'] if result['wall_seconds'] else 0
+    errors = sum(1 for status in result['statuses'] if status != 200)
+    return summarize(result['latencies'], {'throughput_rps': round(throughput, 1), 'errors': errors})
+
+
+def scenario_admin_chat(app, args, stub_state):
+    latencies, statuses = timed_requests(app.test_client(), 'get', '/admin/chat', args.iterations)
+    return summarize(latencies, {'errors': sum(1 for s in statuses if s != 200)})
+
+
+def scenario_admin_friends(app, args, stub_state):
+    latencies, statuses = timed_requests(app.test_client(), 'get', '/admin/friends', args.iterations)
+    return summarize(latencies, {'errors': sum(1 for s in statuses if s != 200)})
+
+
+def drain_delivery_chunks():
+    # 即時送信がバッチに任された場合は、バッチと同じ処理でまとまりを送り切るまでを計測に含める
+    import step_delivery
+    from core import Session
+    session = Session()
+    line_bot_api = step_delivery.get_line_bot_api(session)
+    pacer = step_delivery.SpreadPacer()
+    while step_delivery.process_delivery_chunks(session, line_bot_api, pacer):
+        pass
+    Session.remove()
+
+
+def _send_fanout(app, args, stub_state, text):
+    # 全員への一斉配信（リクエストから全員に送り終わるまで）。API呼び出し回数もあわせて記録する
+    stub_state.reset()
+    client = app.test_client()
+    form = {'targeting_type': 'all', 'message_type': 'text', 'text_content': text}
+    latencies, request_latencies, statuses = [], [], []
+    for _ in range(args.fanout_iterations):
+        started = time.perf_counter()
+        response = client.post('/send-message-from-admin', headers=auth_headers(), data=form)
+        request_latencies.append(time.perf_counter() - started)
+        drain_delivery_chunks()
+        latencies.append(time.perf_counter() - started)
+        statuses.append(response.status_code)
+    calls = stub_state.snapshot()['calls']
+    return summarize(latencies, {
+        'errors': sum(1 for s in statuses if s != 302),
+        'request_p95_ms': summarize(request_latencies)['p95_ms'],
+        'api_calls_per_send': round(sum(calls.values()) / max(args.fanout_iterations, 1), 1),
+    })
+
+
+def scenario_send_fanout(app, args, stub_state):
+    return _send_fanout(app, args, stub_state, '今週のお知らせです')
+
+
+def scenario_send_fanout_personalized(app, args, stub_state):
+    return _send_fanout(app, args, stub_state, '{nickname}さん、今週のお知らせです')
+
+
+def scenario_batch_cycle(app, args, stub_state):
+    import step_delivery
+    from core import Session, User, ScheduledMessage, BatchRunLog
+    latencies = []
+    for _ in range(args.batch_iterations):
+        # 毎回「未送信」の状態に戻してから1サイクル分を計測する
+        session = Session()
+        session.query(User).update({User.sent_steps: ''})
+        session.query(ScheduledMessage).update({ScheduledMessage.status: 'pending'})
+        session.query(BatchRunLog).delete()
+        session.commit()
+        line_bot_api = step_delivery.get_line_bot_api(session)
+        started = time.perf_counter()
+        step_delivery.process_step_messages(session, line_bot_api)
+        step_delivery.process_scheduled_messages(session, line_bot_api)
+        latencies.append(time.perf_counter() - started)
+        Session.remove()
+    return summarize(latencies)
+
+
+SCENARIOS = {
+    'webhook': scenario_webhook,
+    'admin_chat': scenario_admin_chat,
+    'admin_friends': scenario_admin_friends,
+    'send_fanout': scenario_send_fanout,
+    'send_fanout_personalized': scenario_send_fanout_personalized,
+    'batch_cycle': scenario_batch_cycle,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='LINE Bot 管理アプリのベンチマーク')
+    parser.add_argument('--scenarios', default=','.join(ALL_SCENARIOS))
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--messages-per-user', type=int, default=10)
+    parser.add_argument('--scheduled', type=int, default=100)
+    parser.add_argument('--iterations', type=int, default=30, help='管理画面シナリオの計測回数')
+    parser.add_argument('--fanout-iterations', type=int, default=5)
+    parser.add_argument('--batch-iterations', type=int, default=5)
+    parser.add_argument('--webhook-requests', type=int, default=300)
+    parser.add_argument('--webhook-rate', type=float, default=100, help='Webhookの目標リクエスト数/秒')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--latency-ms', type=float, default=5, help='LINE APIスタブの応答遅延')
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='今回の結果をベースラインとして保存する')
+    parser.add_argument('--output', help='結果をJSONで保存するパス')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--reset', action='store_true', help='BENCH_DATABASE_URL のDBの既存データを削除してから投入する')
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"不明なシナリオ: {', '.join(unknown)}")
+
+    server, stub_state = prepare_environment(args)
+    try:
+        from seed import seed
+        print(f"--- データ投入中（{args.users}人 × {args.messages_per_user}件）---")
+        try:
+            seed(args.users, args.messages_per_user, args.scheduled, reset=args.reset)
+        except RuntimeError as e:
+            parser.error(str(e))
+        configure_credentials()
+
+        import main as web
+        app = web.app
+        results = {}
+        for name in scenarios:
+            print(f"--- シナリオ実行中: {name} ---")
+            results[name] = SCENARIOS[name](app, args, stub_state)
+    finally:
+        server.shutdown()
+
+    print()
+    print_table(results)
+    meta = {
+        'users': args.users,
+        'messages_per_user': args.messages_per_user,
+        'stub_latency_ms': args.latency_ms,
+        'database': os.environ['DATABASE_URL'].split(':', 1)[0],
+    }
+    if args.output:
+        save_results(args.output, results, meta)
+    if args.save_baseline:
+        save_results(args.baseline, results, meta)
+        print(f"\nベースラインを保存しました: {args.baseline}")
+        return
+    regressions = compare(results, load_baseline(args.baseline), args.tolerance)
+    if regressions:
+        print(f"\n!!! p95 が悪化したシナリオ: {', '.join(sorted(set(regressions)))}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
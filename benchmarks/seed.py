@@ -0,0 +1,122 @@
+import argparse
+import os
+import random
+import sys
+from datetime import datetime, timezone, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import delete, insert, select
+
+from core import get_engine, User, Tag, Message, ScheduledMessage, StepMessage, BatchRunLog
+
+# --- ベンチマーク用データの投入（SQLite / PostgreSQL 共通）---
+# 使い方: BENCH_DATABASE_URL=... python benchmarks/seed.py --users 10000 --messages-per-user 20
+# アプリの DATABASE_URL は読まない（本番のコンテナ内で実行しても本番DBには書き込まない）。
+# 既存データの削除は --reset を付けた時だけ行う。
+BENCH_TAGS = ['vip', 'campaign', 'satisfied', 'unsatisfied', 'coupon', 'tokyo', 'osaka', 'newsletter']
+BENCH_STATUSES = ['未対応', '対応中', '要対応', '対応済み']
+INSERT_BATCH_SIZE = 5000
+
+
+def user_id_for(index):
+    return f'U{index:032d}'
+
+
+def _insert_batched(conn, table, rows_iter):
+    batch = []
+    for row in rows_iter:
+        batch.append(row)
+        if len(batch) >= INSERT_BATCH_SIZE:
+            conn.execute(insert(table), batch)
+            batch = []
+    if batch:
+        conn.execute(insert(table), batch)
+
+
+def use_bench_database():
+    # BENCH_DATABASE_URL をアプリの DATABASE_URL として使う（core は DATABASE_URL を読むため）
+    url = os.environ.get('BENCH_DATABASE_URL')
+    if url:
+        os.environ['DATABASE_URL'] = url
+    return url
+
+
+def seed(users=1000, messages_per_user=10, scheduled=100, steps=3, reset=False, random_seed=42):
+    rng = random.Random(random_seed)
+    engine = get_engine()
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    with engine.begin() as conn:
+        if reset:
+            for model in (Message, ScheduledMessage, StepMessage, BatchRunLog, User, Tag):
+                conn.execute(delete(model))
+        elif conn.execute(select(User.id).limit(1)).first():
+            raise RuntimeError("投入先のDBに既にユーザーがいます。空のDBを指定するか、削除してよい場合だけ --reset を付けてください。")
+        conn.execute(insert(Tag), [{'name': name} for name in BENCH_TAGS])
+
+        def user_rows():
+            for i in range(users):
+                tags = rng.sample(BENCH_TAGS, rng.randint(0, 3))
+                yield {
+                    'id': user_id_for(i),
+                    'display_name': f'ベンチユーザー{i}',
+                    'nickname': f'ニック{i}' if i % 3 == 0 else None,
+                    'tags': ''.join(f'{tag},' for tag in tags),
+                    'status': rng.choice(BENCH_STATUSES),
+                    'sent_steps': '',
+                    'created_at': now - timedelta(minutes=i),
+                }
+        _insert_batched(conn, User.__table__, user_rows())
+
+        def message_rows():
+            for i in range(users):
+                for j in range(messages_per_user):
+                    yield {
+                        'user_id': user_id_for(i),
+                        'sender_type': 'user' if j % 2 == 0 else 'admin',
+                        'content': f'ベンチマーク用メッセージ {i}-{j}',
+                        'created_at': now - timedelta(minutes=i, seconds=messages_per_user - j),
+                    }
+        _insert_batched(conn, Message.__table__, message_rows())
+
+        def scheduled_rows():
+            for i in range(scheduled):
+                yield {
+                    'user_id': user_id_for(rng.randrange(max(users, 1))),
+                    'message_text': f'予約メッセージ {i}',
+                    # 半分は送信時刻を過ぎた状態にしてバッチの処理対象にする
+                    'send_at': datetime.now(timezone.utc) + timedelta(minutes=-5 if i % 2 == 0 else 60),
+                    'status': 'pending',
+                }
+        _insert_batched(conn, ScheduledMessage.__table__, scheduled_rows())
+
+        # 投入したユーザーは全員「今日」登録なので、0日後のシナリオが配信対象になる
+        conn.execute(insert(StepMessage), [
+            {'days_after': 0, 'message_text': '{nickname}さん、友だち追加ありがとうございます！'},
+        ] + [
+            {'days_after': day, 'message_text': f'{day}日後のお知らせです'} for day in range(1, steps)
+        ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ベンチマーク用データの投入')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages-per-user', type=int, default=10)
+    parser.add_argument('--scheduled', type=int, default=100)
+    parser.add_argument('--steps', type=int, default=3)
+    parser.add_argument('--reset', action='store_true', help='投入前に既存データを削除する（ベンチマーク専用のDBにだけ使う）')
+    args = parser.parse_args()
+
+    if not use_bench_database():
+        print("!!! エラー: BENCH_DATABASE_URL が設定されていません（本番の DATABASE_URL は使いません）。")
+        sys.exit(1)
+    try:
+        seed(args.users, args.messages_per_user, args.scheduled, args.steps, reset=args.reset)
+    except RuntimeError as e:
+        print(f"!!! エラー: {e}")
+        sys.exit(1)
+    print(f"{args.users}人・{args.users * args.messages_per_user}件のメッセージを投入しました。")
+
+
+if __name__ == '__main__':
+    main()
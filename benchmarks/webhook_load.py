@@ -0,0 +1,141 @@
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+# --- 署名付き /callback ペイロードの生成と負荷送信 ---
+# follow / message イベントを X-Line-Signature 付きで生成し、目標レート(req/s)で送り続ける。
+# 使い方: python benchmarks/webhook_load.py --url http://127.0.0.1:8080/callback --secret <channel secret> --rate 50 --duration 30
+MESSAGE_TEXTS = ['こんにちは', '予約したいです', 'アンケート', 'はい', 'クーポン', '営業時間を教えてください']
+
+
+def sign(body, channel_secret):
+    digest = hmac.new(channel_secret.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode('utf-8')
+
+
+def _base_event(event_type, user_id):
+    return {
+        'type': event_type,
+        'mode': 'active',
+        'timestamp': int(time.time() * 1000),
+        'source': {'type': 'user', 'userId': user_id},
+        'webhookEventId': uuid4().hex.upper()[:26],
+        'deliveryContext': {'isRedelivery': False},
+    }
+
+
+def follow_event(user_id):
+    event = _base_event('follow', user_id)
+    event['replyToken'] = uuid4().hex
+    return event
+
+
+def message_event(user_id, text):
+    event = _base_event('message', user_id)
+    event['replyToken'] = uuid4().hex
+    event['message'] = {'id': str(random.randint(10**15, 10**16)), 'type': 'text', 'quoteToken': uuid4().hex, 'text': text}
+    return event
+
+
+def build_payload(events, destination='Ubenchmarkdestination'):
+    return json.dumps({'destination': destination, 'events': events}, ensure_ascii=False)
+
+
+class PayloadGenerator:
+    def __init__(self, user_ids, follow_ratio=0.1, seed=None):
+        self.user_ids = list(user_ids)
+        self.follow_ratio = follow_ratio
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def next_body(self):
+        with self.lock:
+            user_id = self.random.choice(self.user_ids)
+            if self.random.random() < self.follow_ratio:
+                event = follow_event(user_id)
+            else:
+                event = message_event(user_id, self.random.choice(MESSAGE_TEXTS))
+        return build_payload([event])
+
+
+def run_load(send, next_body, channel_secret, rate, total=None, duration=None, concurrency=8):
+    # 送信時刻を 1/rate 秒刻みで予定し、遅れた分は詰めて送る（オープンループ）
+    if total is None:
+        total = int(rate * duration)
+    interval = 1.0 / rate if rate > 0 else 0
+    latencies = []
+    statuses = []
+    lock = threading.Lock()
+
+    def fire():
+        body = next_body()
+        signature = sign(body, channel_secret)
+        started = time.perf_counter()
+        status = send(body, signature)
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            statuses.append(status)
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for i in range(total):
+            scheduled = started_at + i * interval
+            wait = scheduled - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            pool.submit(fire)
+    wall = time.perf_counter() - started_at
+    return {'latencies': latencies, 'statuses': statuses, 'wall_seconds': wall}
+
+
+def http_sender(url, timeout=10):
+    def send(body, signature):
+        request = urllib.request.Request(url, data=body.encode('utf-8'), method='POST', headers={
+            'Content-Type': 'application/json',
+            'X-Line-Signature': signature,
+        })
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+        except Exception:
+            return 0
+    return send
+
+
+def main():
+    from report import summarize, print_table
+
+    parser = argparse.ArgumentParser(description='署名付き Webhook の負荷生成')
+    parser.add_argument('--url', required=True, help='例: http://127.0.0.1:8080/callback')
+    parser.add_argument('--secret', required=True, help='チャネルシークレット（管理画面の設定と同じ値）')
+    parser.add_argument('--rate', type=float, default=20, help='目標リクエスト数/秒')
+    parser.add_argument('--duration', type=float, default=10, help='送信する秒数')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--users', type=int, default=1000, help='送信元ユーザーIDの種類（seed.py と同じ U%%032d 形式）')
+    parser.add_argument('--follow-ratio', type=float, default=0.1)
+    args = parser.parse_args()
+
+    user_ids = [f'U{i:032d}' for i in range(args.users)]
+    generator = PayloadGenerator(user_ids, args.follow_ratio)
+    result = run_load(http_sender(args.url), generator.next_body, args.secret, args.rate,
+                      duration=args.duration, concurrency=args.concurrency)
+    ok = sum(1 for status in result['statuses'] if status == 200)
+    print(f"送信 {len(result['statuses'])} 件 / 成功 {ok} 件 / {len(result['statuses']) / result['wall_seconds']:.1f} req/s")
+    print_table({'webhook_http': summarize(result['latencies'])})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+import json
+import math
+import os
+from datetime import datetime, timezone, timedelta
+
+from sqlalchemy import and_, exists
+
+from core import User, ScheduledBroadcast, DeliveryChunk, DeliveryPayload
+from personalize import compile_template, has_placeholders, group_recipients, deliver_grouped, MULTICAST_CHUNK_SIZE
+
+# --- 一斉配信（管理画面の即時送信と、バッチの予約配信で共有する）---
+# フォームの入力（予約配信では messages_info に保存したもの）からメッセージを組み立て、
+# 対象ユーザーを絞り込んで送信する。画像はアップロード済みのファイル名と公開URLから参照する。
+
+
+def public_base_url():
+    # Webの管理画面の外（バッチ）から画像URLを組み立てる時に使う
+    base_url = os.environ.get('PUBLIC_BASE_URL') or os.environ.get('NGROK_URL')
+    return base_url.rstrip('/') if base_url else None
+
+
+def select_recipients(session, targeting_type, include_tags=(), exclude_tags=()):
+    query = session.query(User)
+    if targeting_type == 'segmented' and (include_tags or exclude_tags):
+        if include_tags: query = query.filter(and_(*[User.tags.like(f'%{tag}%') for tag in include_tags]))
+        if exclude_tags: query = query.filter(and_(*[User.tags.notlike(f'%{tag}%') for tag in exclude_tags]))
+    return query.all()
+
+
+def build_messages(request_form, image_files, base_url):
+    from linebot.models import (
+        TextSendMessage, MessageAction, ImageSendMessage,
+        TemplateSendMessage, ButtonsTemplate, CarouselTemplate, CarouselColumn, URIAction,
+        ImagemapSendMessage, BaseSize, ImagemapArea, URIImagemapAction, MessageImagemapAction
+    )
+    messages_to_send = []
+    message_types = request_form.getlist('message_type')
+    text_contents = request_form.getlist('text_content')
+    imagemap_alt_texts = request_form.getlist('imagemap_alt_text')
+    imagemap_action_types = request_form.getlist('imagemap_action_type')
+    imagemap_action_data = request_form.getlist('imagemap_action_data')
+    button_titles = request_form.getlist('button_title')
+    button_texts = request_form.getlist('button_text')
+    carousel_alt_texts = request_form.getlist('carousel_alt_text')
+    action_message_indices = request_form.getlist('action_message_index', type=int)
+    action_labels = request_form.getlist('action_label')
+    action_types = request_form.getlist('action_type')
+    action_data = request_form.getlist('action_data')
+    column_message_indices = request_form.getlist('column_message_index', type=int)
+    column_titles = request_form.getlist('column_title')
+    column_texts = request_form.getlist('column_text')
+    column_image_urls = request_form.getlist('column_image_url')
+    action_column_indices = request_form.getlist('action_column_index', type=int)
+    text_idx, file_idx, button_idx, carousel_idx, imagemap_idx, action_idx, column_idx = 0, 0, 0, 0, 0, 0, 0
+    for i, msg_type in enumerate(message_types):
+        if len(messages_to_send) >= 5: break
+        if msg_type == 'text':
+            if text_idx < len(text_contents) and text_contents[text_idx]:
+                messages_to_send.append(TextSendMessage(text=text_contents[text_idx]))
+            text_idx += 1
+        elif msg_type == 'image' or msg_type == 'imagemap':
+            filename = image_files.get(f'image_file_{i}')
+            if filename:
+                if not base_url:
+                    print("!!! PUBLIC_BASE_URL が設定されていないため、画像メッセージを送信できません。")
+                else:
+                    image_url = f"{base_url}/uploads/{filename}"
+                    if msg_type == 'image':
+                        messages_to_send.append(ImageSendMessage(original_content_url=image_url, preview_image_url=image_url))
+                    else:
+                        alt_text = imagemap_alt_texts[imagemap_idx] if imagemap_idx < len(imagemap_alt_texts) else "画像メッセージ"
+                        action_type = imagemap_action_types[imagemap_idx] if imagemap_idx < len(imagemap_action_types) else 'message'
+                        imagemap_data = imagemap_action_data[imagemap_idx] if imagemap_idx < len(imagemap_action_data) else ''
+                        action = None
+                        area = ImagemapArea(x=0, y=0, width=1040, height=1040)
+                        if action_type == 'uri' and imagemap_data.startswith('http'):
+                            action = URIImagemapAction(link_uri=imagemap_data, area=area)
+                        elif action_type == 'message' and imagemap_data:
+                             action = MessageImagemapAction(text=imagemap_data, area=area)
+                        if action:
+                            message = ImagemapSendMessage(base_url=image_url, alt_text=alt_text, base_size=BaseSize(height=1040, width=1040), actions=[action])
+                            messages_to_send.append(message)
+                        imagemap_idx += 1
+            file_idx += 1
+        elif msg_type == 'button':
+            actions = []
+            num_actions = action_message_indices.count(i)
+            for _ in range(num_actions):
+                 if len(actions) >= 4: break
+                 if action_idx < len(action_labels):
+                    label = action_labels[action_idx]
+                    action_type = action_types[action_idx]
+                    data = action_data[action_idx]
+                    if action_type == 'uri' and data.startswith('http'): actions.append(URIAction(label=label, uri=data))
+                    elif action_type == 'message': actions.append(MessageAction(label=label, text=data))
+                 action_idx += 1
+            if actions:
+                template = ButtonsTemplate(
+                    title=button_titles[button_idx] if button_idx < len(button_titles) and button_titles[button_idx] else None,
+                    text=button_texts[button_idx] if button_idx < len(button_texts) else " ",
+                    actions=actions
+                )
+                messages_to_send.append(TemplateSendMessage(alt_text='ボタンメッセージ', template=template))
+            button_idx += 1
+        elif msg_type == 'carousel':
+            columns = []
+            num_columns = column_message_indices.count(i)
+            for _ in range(num_columns):
+                if len(columns) >= 10: break
+                actions = []
+                num_actions = action_column_indices.count(column_idx)
+                for _ in range(num_actions):
+                    if len(actions) >= 3: break
+                    if action_idx < len(action_labels):
+                        label = action_labels[action_idx]
+                        action_type = action_types[action_idx]
+                        data = action_data[action_idx]
+                        if action_type == 'uri' and data.startswith('http'): actions.append(URIAction(label=label, uri=data))
+                        elif action_type == 'message': actions.append(MessageAction(label=label, text=data))
+                    action_idx += 1
+                column = CarouselColumn(
+                    thumbnail_image_url=column_image_urls[column_idx] if column_idx < len(column_image_urls) and column_image_urls[column_idx] else None,
+                    title=column_titles[column_idx] if column_idx < len(column_titles) else None,
+                    text=column_texts[column_idx] if column_idx < len(column_texts) else " ",
+                    actions=actions
+                )
+                columns.append(column)
+                column_idx += 1
+            if columns:
+                alt_text = carousel_alt_texts[carousel_idx] if carousel_idx < len(carousel_alt_texts) and carousel_alt_texts[carousel_idx] else "カルーセル"
+                template = CarouselTemplate(columns=columns)
+                messages_to_send.append(TemplateSendMessage(alt_text=alt_text, template=template))
+            carousel_idx += 1
+    return messages_to_send
+
+
+class RawMessage:
+    # 変換済みのJSONをそのまま送る（linebot の送信メソッドは各メッセージの as_json_dict() だけを呼ぶ）
+    def __init__(self, payload):
+        self.payload = payload
+
+    def as_json_dict(self):
+        return self.payload
+
+
+def compile_personalized(payload):
+    # 差し込みのあるテキストだけを一度コンパイルする（キーは payload 内の位置）
+    return {
+        idx: compile_template(message['text'])
+        for idx, message in enumerate(payload)
+        if message.get('type') == 'text' and has_placeholders(message.get('text'))
+    }
+
+
+def count_api_calls(users, payload):
+    # deliver が送るときの LINE API の呼び出し回数（1人だけのグループは push、それ以外は multicast を分割）
+    groups = group_recipients(users, list(compile_personalized(payload).values()))
+    return sum(math.ceil(len(user_ids) / MULTICAST_CHUNK_SIZE) for user_ids in groups.values())
+
+
+def deliver(line_bot_api, users, payload, on_sent=None):
+    # payload は LINE API の messages 配列。描画結果が同じユーザーをまとめて送る
+    # （差し込みがなければ全員が1グループになる）
+    personalized = compile_personalized(payload)
+    groups = group_recipients(users, list(personalized.values()))
+
+    def build_personalized(rendered):
+        messages = list(payload)
+        for idx, text in zip(personalized.keys(), rendered):
+            messages[idx] = dict(messages[idx], text=text)
+        return [RawMessage(message) for message in messages]
+
+    deliver_grouped(line_bot_api, groups, build_personalized, on_sent)
+
+
+# --- 分散配信 ---
+# 大きな配信を一度に送ると、返信が一斉に /callback へ届いてWebとバッチが追いつかなくなる。
+# 「配信にかける時間」か「1分あたりの最大送信数」を指定すると、宛先を小さなまとまり（DeliveryChunk）に
+# 分けて送信予定時刻をずらして保存し、バッチ（step_delivery.py）が受信の混み具合を見ながら順に送る。
+MAX_SPREAD_MINUTES = 24 * 60
+# バッチが分散配信を確認する間隔。まとまりの大きさはこの間隔ごとに1つ送る程度にする
+SPREAD_TICK_SECONDS = int(os.environ.get('SPREAD_TICK_SECONDS', 5))
+
+
+class SpreadError(ValueError):
+    pass
+
+
+def parse_spread(request_form):
+    # 空欄は指定なし。どちらも空なら一度に送る
+    values = []
+    for key, label in (('spread_minutes', '配信にかける時間（分）'), ('max_per_minute', '1分あたりの最大送信数')):
+        text = (request_form.get(key) or '').strip()
+        if not text:
+            values.append(None)
+            continue
+        if not text.isdigit() or int(text) == 0:
+            raise SpreadError(f"{label}は1以上の整数で指定してください。")
+        values.append(int(text))
+    spread_minutes, max_per_minute = values
+    if spread_minutes and spread_minutes > MAX_SPREAD_MINUTES:
+        raise SpreadError(f"配信にかける時間は{MAX_SPREAD_MINUTES}分までです。")
+    return spread_minutes, max_per_minute
+
+
+def plan_chunks(user_ids, start, spread_minutes=None, max_per_minute=None):
+    # [(送信予定時刻, 宛先IDのリスト), ...] を返す。
+    # 時間の指定からは全員を送り切るのに必要な速度を求め、最大送信数の指定があればそれを上限にする。
+    # どちらもなければ速度を抑えず、multicast の上限ごとに分けて全部を start に置く
+    if not spread_minutes and not max_per_minute:
+        return [(start, user_ids[i:i + MULTICAST_CHUNK_SIZE]) for i in range(0, len(user_ids), MULTICAST_CHUNK_SIZE)]
+    per_minute = max_per_minute
+    if spread_minutes:
+        window_rate = math.ceil(len(user_ids) / spread_minutes)
+        per_minute = min(per_minute, window_rate) if per_minute else window_rate
+    per_minute = max(per_minute or 1, 1)
+    chunk_size = min(MULTICAST_CHUNK_SIZE, max(1, math.ceil(per_minute * SPREAD_TICK_SECONDS / 60)))
+    interval = timedelta(minutes=chunk_size / per_minute)
+    return [
+        (start + interval * n, user_ids[i:i + chunk_size])
+        for n, i in enumerate(range(0, len(user_ids), chunk_size))
+    ]
+
+
+def enqueue_spread(session, source, source_id, users, payload, start, spread_minutes=None, max_per_minute=None):
+    # 保存するだけで送信はしない（コミットは呼び出し元で行う）。内容は1行だけ保存し、各まとまりは宛先だけを持つ。
+    # 差し込み後の内容が同じ宛先を並べてから分けるので、まとまりの中でまとめて multicast できる
+    stored = DeliveryPayload(payload=json.dumps(payload, ensure_ascii=False))
+    session.add(stored)
+    session.flush()
+    groups = group_recipients(users, list(compile_personalized(payload).values()))
+    user_ids = [user_id for group in groups.values() for user_id in group]
+    chunks = plan_chunks(user_ids, start, spread_minutes, max_per_minute)
+    session.add_all([
+        DeliveryChunk(
+            source=source,
+            source_id=source_id,
+            user_ids=json.dumps(chunk_user_ids),
+            recipient_count=len(chunk_user_ids),
+            payload_id=stored.id,
+            send_after=send_after,
+            status='pending',
+            attempts=0
+        )
+        for send_after, chunk_user_ids in chunks
+    ])
+    return chunks
+
+
+def load_payload(session, chunk):
+    stored = session.get(DeliveryPayload, chunk.payload_id) if chunk.payload_id else None
+    if stored is None:
+        raise ValueError("配信内容が見つかりません。")
+    return json.loads(stored.payload)
+
+
+def purge_unused_payloads(session):
+    # 参照するまとまりがなくなった配信内容を消す（内容とまとまりは同じトランザクションで保存するので、保存途中の行は消さない）
+    deleted = session.query(DeliveryPayload).filter(
+        ~exists().where(DeliveryChunk.payload_id == DeliveryPayload.id)
+    ).delete(synchronize_session=False)
+    session.commit()
+    return deleted
+
+
+# 即時送信でこの回数を超えて LINE API を呼ぶ場合（差し込みで宛先ごとに内容が変わる場合など）は、
+# リクエスト内で送るとワーカーのタイムアウトを超えるおそれがあるのでバッチに任せる
+INLINE_SEND_MAX_CALLS = int(os.environ.get('INLINE_SEND_MAX_CALLS', 20))
+
+
+def queue_broadcast(session, name, targeting_info, payload, users, spread_minutes=None, max_per_minute=None):
+    # 管理画面の即時送信をバッチに任せる。予約配信の行（送信中）として残すので、一覧から進捗の確認と停止ができる
+    now = datetime.now(timezone.utc)
+    broadcast = ScheduledBroadcast(
+        name=name or '無題の配信',
+        targeting_info=json.dumps(targeting_info),
+        messages_info=json.dumps({'payload': payload}, ensure_ascii=False),
+        send_at=now,
+        status='sending',
+        spread_minutes=spread_minutes,
+        max_per_minute=max_per_minute
+    )
+    session.add(broadcast)
+    session.flush()
+    enqueue_spread(session, 'broadcast', broadcast.id, users, payload, now, spread_minutes, max_per_minute)
+    return broadcast
+
+
+def finish_queued_broadcast(session, broadcast_id):
+    # 送信中の配信は、送信待ち・失敗したまとまりがなくなった時点で送信済みにする（コミットは呼び出し元）
+    if session.query(DeliveryChunk.id).filter_by(source='broadcast', source_id=broadcast_id).first():
+        return False
+    broadcast = session.get(ScheduledBroadcast, broadcast_id)
+    if broadcast is not None and broadcast.status == 'sending':
+        broadcast.status = 'sent'
+    return True
+
+
+def cancel_spread(session, source, source_id):
+    # 配信やシナリオを削除した時に、まだ送っていない分と失敗した分を取り消す
+    return session.query(DeliveryChunk).filter_by(
+        source=source, source_id=source_id
+    ).delete(synchronize_session=False)
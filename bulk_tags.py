@@ -0,0 +1,260 @@
+import csv
+import io
+import json
+import threading
+from datetime import datetime, timezone, timedelta
+from uuid import uuid4
+
+from sqlalchemy import func, literal, update
+
+from core import _create_session, User, Tag, BulkTagJob
+import cache
+from recurrence import as_utc
+
+# --- CSV / JSONL によるタグの一括付与・削除 ---
+# 入力は user_id ごとに「追加するタグ」「削除するタグ」を持つ行の集まり。
+# 行を CHUNK_SIZE 件ずつまとめ、タグごとに1本の UPDATE 文（集合演算）で反映する。
+CHUNK_SIZE = 1000
+TAG_SEPARATORS = (';', '|')
+
+
+class BulkTagError(ValueError):
+    pass
+
+
+def _split_tags(value):
+    if not value:
+        return []
+    if isinstance(value, list):
+        tags = value
+    else:
+        value = str(value)
+        for separator in TAG_SEPARATORS:
+            value = value.replace(separator, ',')
+        tags = value.split(',')
+    # tags カラムはカンマ区切りで保存しているため、タグ名にカンマは含められない
+    return [str(tag).strip() for tag in tags if str(tag).strip()]
+
+
+def decode_upload(data):
+    # ExcelでCSV保存すると Shift_JIS（cp932）になることが多いので、UTF-8で読めなければそちらで読む
+    for encoding in ('utf-8-sig', 'cp932'):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    raise BulkTagError("文字コードを判別できません。UTF-8 か Shift_JIS で保存してください。")
+
+
+def parse_records(raw_text, fmt):
+    records = []
+    if fmt == 'jsonl':
+        for line_no, line in enumerate(raw_text.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                raise BulkTagError(f"{line_no}行目のJSONが正しくありません。")
+            records.append(_to_record(row, line_no))
+    elif fmt == 'csv':
+        reader = csv.DictReader(io.StringIO(raw_text.lstrip('\ufeff')))
+        if not reader.fieldnames or 'user_id' not in reader.fieldnames:
+            raise BulkTagError("CSVのヘッダーに user_id 列が必要です。")
+        try:
+            for line_no, row in enumerate(reader, 2):
+                records.append(_to_record(row, line_no))
+        except csv.Error as e:
+            raise BulkTagError(f"{reader.line_num}行目のCSVが正しくありません: {e}")
+    else:
+        raise BulkTagError("対応していない形式です。")
+    return records
+
+
+def _to_record(row, line_no):
+    if not isinstance(row, dict):
+        raise BulkTagError(f"{line_no}行目がJSONオブジェクトではありません。")
+    user_id = row.get('user_id')
+    user_id = '' if user_id is None else str(user_id).strip()
+    if not user_id:
+        raise BulkTagError(f"{line_no}行目に user_id がありません。")
+    # tags 列は add_tags の別名として扱う
+    add_tags = _split_tags(row.get('add_tags')) + _split_tags(row.get('tags'))
+    remove_tags = _split_tags(row.get('remove_tags'))
+    return user_id, tuple(add_tags), tuple(remove_tags)
+
+
+def detect_format(filename, content_type):
+    filename = (filename or '').lower()
+    content_type = (content_type or '').lower()
+    if filename.endswith('.jsonl') or filename.endswith('.ndjson') or 'ndjson' in content_type or 'jsonl' in content_type:
+        return 'jsonl'
+    return 'csv'
+
+
+def _like_escape(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _insert_ignore(engine, table):
+    # 値は executemany で渡す（VALUES を毎回組み立てるとSQLのコンパイルが支配的になる）
+    if engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif engine.dialect.name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise BulkTagError(f"{engine.dialect.name} には対応していません。")
+    return insert(table).on_conflict_do_nothing()
+
+
+def apply_chunk(session, chunk, create_missing_users=False):
+    engine = session.get_bind()
+
+    if create_missing_users:
+        user_rows = [{'id': user_id, 'tags': '', 'status': '未対応', 'sent_steps': ''} for user_id in {r[0] for r in chunk}]
+        session.execute(_insert_ignore(engine, User.__table__), user_rows)
+
+    tag_names = {tag for _, add_tags, _ in chunk for tag in add_tags}
+    if tag_names:
+        session.execute(_insert_ignore(engine, Tag.__table__), [{'name': name} for name in sorted(tag_names)])
+
+    # タグごとに対象ユーザーをまとめる（削除 → 追加の順に反映）
+    removals, additions = {}, {}
+    for user_id, add_tags, remove_tags in chunk:
+        for tag in remove_tags:
+            removals.setdefault(tag, set()).add(user_id)
+        for tag in add_tags:
+            additions.setdefault(tag, set()).add(user_id)
+
+    padded_tags = literal(',') + func.coalesce(User.tags, '')
+    updated = 0
+    for tag, user_ids in removals.items():
+        result = session.execute(
+            update(User)
+            .where(User.id.in_(user_ids))
+            .where(padded_tags.like(f'%,{_like_escape(tag)},%', escape='\\'))
+            .values(tags=func.substr(func.replace(padded_tags, f',{tag},', ','), 2))
+            .execution_options(synchronize_session=False)
+        )
+        updated += result.rowcount
+    for tag, user_ids in additions.items():
+        result = session.execute(
+            update(User)
+            .where(User.id.in_(user_ids))
+            .where(padded_tags.notlike(f'%,{_like_escape(tag)},%', escape='\\'))
+            .values(tags=func.coalesce(User.tags, '') + f'{tag},')
+            .execution_options(synchronize_session=False)
+        )
+        updated += result.rowcount
+    session.commit()
+    return updated
+
+
+# --- 進捗を確認できるバックグラウンドジョブ ---
+# 進捗は bulk_tag_jobs テーブルに保存する（WEB_CONCURRENCY>1 でも、どのワーカーからでも確認できる）。
+# 処理はアップロードを受けたワーカーのスレッドで行い、まとまりごとに進捗と heartbeat_at を更新する。
+# ワーカーの再起動などで heartbeat_at が STALE_JOB_SECONDS 以上止まったジョブは、バッチが続きから再開する
+# （apply_chunk は同じ行を2回反映しても結果が変わらない）。
+STALE_JOB_SECONDS = 120
+MAX_KEPT_JOBS = 50
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def job_to_dict(job):
+    end = as_utc(job.finished_at) if job.finished_at else _now()
+    return {
+        'id': job.id,
+        'status': job.status,
+        'total': job.total,
+        'processed': job.processed,
+        'updated': job.updated,
+        'error': job.error,
+        'elapsed_seconds': round((end - as_utc(job.started_at)).total_seconds(), 2),
+    }
+
+
+def get_job(session, job_id):
+    job = session.get(BulkTagJob, job_id)
+    return job_to_dict(job) if job else None
+
+
+def run_job(job_id):
+    # バッチのスレッドからも呼ぶので、スレッドローカルなセッションを閉じてしまわないよう独立したセッションを使う
+    session = _create_session()
+    try:
+        job = session.get(BulkTagJob, job_id)
+        records = [(user_id, tuple(add_tags), tuple(remove_tags)) for user_id, add_tags, remove_tags in json.loads(job.records)]
+        create_missing_users = job.create_missing_users
+        for i in range(job.processed, len(records), CHUNK_SIZE):
+            chunk = records[i:i + CHUNK_SIZE]
+            updated = apply_chunk(session, chunk, create_missing_users)
+            job.updated += updated
+            job.processed = i + len(chunk)
+            job.heartbeat_at = _now()
+            session.commit()
+        job.status = 'done'
+        job.records = None
+        job.finished_at = _now()
+        session.commit()
+        cache.invalidate(cache.TAGS_KEY, cache.TAGS_PAGE_KEY)
+    except Exception as e:
+        session.rollback()
+        print(f"!!! タグ一括更新でエラー: {e}")
+        job = session.get(BulkTagJob, job_id)
+        if job:
+            job.status = 'error'
+            job.error = str(e)
+            job.records = None
+            job.finished_at = _now()
+            session.commit()
+    finally:
+        session.close()
+
+
+def start_job(session, records, create_missing_users=False):
+    now = _now()
+    job = BulkTagJob(
+        id=uuid4().hex,
+        status='running',
+        total=len(records),
+        processed=0,
+        updated=0,
+        create_missing_users=create_missing_users,
+        records=json.dumps(records, ensure_ascii=False),
+        started_at=now,
+        heartbeat_at=now
+    )
+    session.add(job)
+    # 古いジョブの記録は捨てる
+    kept_ids = [job_id for (job_id,) in session.query(BulkTagJob.id).order_by(BulkTagJob.started_at.desc()).limit(MAX_KEPT_JOBS)]
+    if kept_ids:
+        session.query(BulkTagJob).filter(
+            BulkTagJob.status != 'running',
+            BulkTagJob.id.notin_(kept_ids)
+        ).delete(synchronize_session=False)
+    session.commit()
+    job_dict = job_to_dict(job)
+    thread = threading.Thread(target=run_job, args=(job.id,), daemon=True)
+    thread.start()
+    return job_dict
+
+
+def resume_stale_jobs(session):
+    # バッチから呼ぶ。止まったジョブを1件ずつ取り出し、このプロセスで続きから処理する
+    resumed = 0
+    while True:
+        job = session.query(BulkTagJob).filter(
+            BulkTagJob.status == 'running',
+            BulkTagJob.heartbeat_at < _now() - timedelta(seconds=STALE_JOB_SECONDS)
+        ).with_for_update(skip_locked=True).first()
+        if job is None:
+            return resumed
+        print(f"中断したタグ一括更新(ID: {job.id})を{job.processed}/{job.total}行目から再開します。")
+        job.heartbeat_at = _now()
+        job_id = job.id
+        session.commit()
+        run_job(job_id)
+        resumed += 1
@@ -0,0 +1,190 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import events
+import metrics
+
+# --- 管理画面用の小さなキャッシュ ---
+# REDIS_URL が設定されていれば Redis を共有キャッシュとして使う。
+# PostgreSQL ではプロセス内の LRU + TTL を使い、無効化は events の LISTEN/NOTIFY で全プロセス
+# （Webの各ワーカーとバッチ）へ伝える。どちらもない場合（SQLite）は無効化を他のプロセスへ伝えられないため
+# キャッシュしない（CACHE_BACKEND=local で1プロセスだけの場合に LRU を使える。ベンチマーク用）。
+# 値は JSON に変換できるもの（dict / list / str）に限る。
+DEFAULT_TTL = int(os.environ.get('CACHE_TTL_SECONDS', 60))
+DEFAULT_MAXSIZE = int(os.environ.get('CACHE_MAXSIZE', 256))
+REDIS_KEY_PREFIX = 'linebot:cache:'
+
+# キャッシュキー（書き込み側の無効化と揃えるため、ここで一元管理する）
+TAGS_KEY = 'tags'
+TAGS_PAGE_KEY = 'page:admin_tags'
+PENDING_BROADCASTS_KEY = 'pending_broadcasts'
+SURVEY_FLOWS_KEY = 'survey_flows'
+MESSAGE_TEMPLATES_KEY = 'message_templates'
+
+INVALIDATE_EVENT = 'cache_invalidate'
+
+cache_requests = metrics.registry.register(metrics.Counter(
+    'linebot_cache_requests_total', 'キャッシュの参照回数（ヒット / ミス）', ('cache', 'result')))
+cache_invalidations = metrics.registry.register(metrics.Counter(
+    'linebot_cache_invalidations_total', '書き込みによるキャッシュ無効化の回数', ('cache',)))
+cache_entries = metrics.registry.register(metrics.Gauge(
+    'linebot_cache_entries', 'プロセス内キャッシュの保持件数'))
+
+
+class LRUCache:
+    def __init__(self, maxsize=DEFAULT_MAXSIZE):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return False, None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return False, None
+            self._data.move_to_end(key)
+            return True, value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class NullCache:
+    def get(self, key):
+        return False, None
+
+    def set(self, key, value, ttl):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+
+class RedisCache:
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, key):
+        raw = self.client.get(REDIS_KEY_PREFIX + key)
+        if raw is None:
+            return False, None
+        return True, json.loads(raw)
+
+    def set(self, key, value, ttl):
+        self.client.setex(REDIS_KEY_PREFIX + key, ttl, json.dumps(value, ensure_ascii=False))
+
+    def delete(self, key):
+        self.client.delete(REDIS_KEY_PREFIX + key)
+
+
+def _uses_postgres():
+    return (os.environ.get('DATABASE_URL') or '').startswith(('postgres://', 'postgresql'))
+
+
+def _create_backend():
+    redis_url = os.environ.get('REDIS_URL')
+    if redis_url:
+        try:
+            import redis
+            return RedisCache(redis.Redis.from_url(redis_url))
+        except ImportError:
+            print("!!! REDIS_URL が設定されていますが redis パッケージがないため、Redis は使いません。")
+    if os.environ.get('CACHE_BACKEND') == 'local' or _uses_postgres():
+        return LRUCache()
+    return NullCache()
+
+
+_backend = _create_backend()
+# プロセス内の LRU を PostgreSQL の NOTIFY で無効化する場合だけ True
+_broadcast_invalidations = isinstance(_backend, LRUCache) and _uses_postgres()
+_listener_started = False
+_listener_lock = threading.Lock()
+
+
+def _drop_local(data):
+    for key in data.get('keys', []):
+        _backend.delete(key)
+
+
+def _ensure_listener():
+    # gunicorn の preload_app でフォークした後の各プロセスで、最初にキャッシュを使う時に開始する
+    global _listener_started
+    if not _broadcast_invalidations or _listener_started:
+        return
+    with _listener_lock:
+        if _listener_started:
+            return
+        from core import get_engine
+        # 接続し直した時は、切断中に届かなかった無効化があり得るので全て捨てる
+        events.broker.add_handler(INVALIDATE_EVENT, _drop_local, on_connect=_backend.clear)
+        events.broker.listen(get_engine())
+        _listener_started = True
+
+
+def _cache_name(key):
+    return key.split(':', 1)[0]
+
+
+def get_or_load(key, loader, ttl=DEFAULT_TTL):
+    _ensure_listener()
+    try:
+        found, value = _backend.get(key)
+    except Exception as e:
+        # 共有キャッシュが落ちていても画面は表示できるようにする
+        print(f"!!! キャッシュの参照でエラー: {e}")
+        found, value = False, None
+    cache_requests.inc(cache=_cache_name(key), result='hit' if found else 'miss')
+    if found:
+        return value
+    value = loader()
+    try:
+        _backend.set(key, value, ttl)
+    except Exception as e:
+        print(f"!!! キャッシュの保存でエラー: {e}")
+    return value
+
+
+def invalidate(*keys):
+    for key in keys:
+        cache_invalidations.inc(cache=_cache_name(key))
+        try:
+            _backend.delete(key)
+        except Exception as e:
+            print(f"!!! キャッシュの無効化でエラー: {e}")
+    if _broadcast_invalidations and keys:
+        # 他のワーカーやバッチのプロセス内キャッシュからも消す（自分にも届くが、削除済みなので問題ない）
+        from core import get_engine
+        events.publish(get_engine(), INVALIDATE_EVENT, {'keys': list(keys)})
+
+
+def _collect_entries():
+    if isinstance(_backend, LRUCache):
+        cache_entries.set(len(_backend))
+
+
+metrics.registry.add_collector(_collect_entries)
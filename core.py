@@ -0,0 +1,347 @@
+import os
+import threading
+
+from sqlalchemy import create_engine, inspect, text, Column, String, DateTime, func, Integer, Text, Boolean, Index
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import sessionmaker, scoped_session, declarative_base
+
+import metrics
+
+# --- main.py（Web管理画面）と step_delivery.py（バッチ）で共有する設定・モデル ---
+# インポート時にはDB接続もDDLも行わない。エンジンとスキーマの確認は最初の利用時に一度だけ実行する。
+
+def get_database_url():
+    db_url_from_env = os.environ.get('DATABASE_URL')
+    if db_url_from_env and db_url_from_env.startswith("postgres://"):
+        return db_url_from_env.replace("postgres://", "postgresql+psycopg://", 1)
+    return db_url_from_env
+
+# --- データベースのモデル定義 ---
+Base = declarative_base()
+class User(Base):
+    __tablename__ = 'users'
+    id = Column(String, primary_key=True)
+    display_name = Column(String)
+    nickname = Column(String)
+    tags = Column(String, default="")
+    status = Column(String, default="未対応")
+    sent_steps = Column(String, default="")
+    created_at = Column(DateTime, server_default=func.now())
+
+class StepMessage(Base):
+    __tablename__ = 'step_messages'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    days_after = Column(Integer, nullable=False)
+    message_text = Column(Text, nullable=False)
+    # テンプレートを指定した場合は message_text の代わりにテンプレートの内容を送る
+    template_id = Column(Integer)
+    # 分散配信（どちらも空なら一度に送る）
+    spread_minutes = Column(Integer)
+    max_per_minute = Column(Integer)
+
+class Setting(Base):
+    __tablename__ = 'settings'
+    key = Column(String, primary_key=True)
+    value = Column(Text)
+
+class Tag(Base):
+    __tablename__ = 'tags'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String, nullable=False, unique=True)
+
+class Message(Base):
+    __tablename__ = 'messages'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(String, nullable=False)
+    sender_type = Column(String, nullable=False)
+    content = Column(Text, nullable=False)
+    created_at = Column(DateTime, server_default=func.now())
+    # バッチが直近の受信件数を数えて分散配信の速度を調整するため
+    __table_args__ = (Index('ix_messages_sender_created', 'sender_type', 'created_at'),)
+
+class ScheduledMessage(Base):
+    __tablename__ = 'scheduled_messages'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(String, nullable=False)
+    message_text = Column(Text, nullable=False)
+    # 繰り返しの予約では、送信のたびに send_at を次回の時刻へ進める
+    send_at = Column(DateTime(timezone=True), nullable=False)
+    status = Column(String, default='pending')
+    recurrence = Column(String)
+    timezone = Column(String)
+    __table_args__ = (Index('ix_scheduled_messages_due', 'status', 'send_at'),)
+
+class ScheduledBroadcast(Base):
+    __tablename__ = 'scheduled_broadcasts'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String, default="無題の配信")
+    targeting_info = Column(Text, nullable=False)
+    messages_info = Column(Text, nullable=False)
+    send_at = Column(DateTime(timezone=True), nullable=False)
+    # pending / sending（分散配信の送信中。未送信・失敗した分がなくなると sent）/ sent / error
+    status = Column(String, default='pending')
+    recurrence = Column(String)
+    timezone = Column(String)
+    spread_minutes = Column(Integer)
+    max_per_minute = Column(Integer)
+    __table_args__ = (Index('ix_scheduled_broadcasts_due', 'status', 'send_at'),)
+
+class BulkTagJob(Base):
+    # タグ一括更新の進捗。どのワーカーからでも参照でき、途中で止まったジョブはバッチが続きから再開する
+    __tablename__ = 'bulk_tag_jobs'
+    id = Column(String(32), primary_key=True)
+    status = Column(String, nullable=False, default='running')  # running / done / error
+    total = Column(Integer, nullable=False, default=0)
+    processed = Column(Integer, nullable=False, default=0)
+    updated = Column(Integer, nullable=False, default=0)
+    create_missing_users = Column(Boolean, default=False)
+    records = Column(Text)  # 入力（JSON）。完了したら消す
+    error = Column(Text)
+    started_at = Column(DateTime(timezone=True), nullable=False)
+    heartbeat_at = Column(DateTime(timezone=True), nullable=False)
+    finished_at = Column(DateTime(timezone=True))
+
+class DeliveryPayload(Base):
+    # 分散配信で送る内容（LINE API の messages 配列のJSON）。1回の配信につき1行だけ保存し、まとまりから参照する。
+    # 参照するまとまりがなくなった行はバッチが削除する
+    __tablename__ = 'delivery_payloads'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    payload = Column(Text, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class DeliveryChunk(Base):
+    # 分散配信で時間をずらして送る宛先のまとまり。バッチが send_after を過ぎたものから送り、送信後に削除する
+    __tablename__ = 'delivery_chunks'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    source = Column(String, nullable=False)  # 'broadcast' / 'step'
+    source_id = Column(Integer)  # 予約配信・ステップ配信のID
+    user_ids = Column(Text, nullable=False)  # JSONの配列（送信に失敗した場合は未送信の宛先だけが残る）
+    recipient_count = Column(Integer)
+    payload_id = Column(Integer, index=True)  # delivery_payloads.id
+    send_after = Column(DateTime(timezone=True), nullable=False)
+    status = Column(String, default='pending')  # pending / error（送信できたものは削除する）
+    attempts = Column(Integer, default=0)
+    last_error = Column(Text)
+    __table_args__ = (Index('ix_delivery_chunks_due', 'status', 'send_after'),)
+
+class SurveyFlow(Base):
+    __tablename__ = 'survey_flows'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String, nullable=False)
+    trigger_keyword = Column(String, nullable=False, unique=True)
+    # [{"text": 質問文, "choices": [{"label": 選択肢, "tag": 付与するタグ or null}, ...]}, ...] のJSON
+    questions = Column(Text, nullable=False)
+    completion_message = Column(Text, nullable=False)
+    is_active = Column(Boolean, default=True, nullable=False)
+    created_at = Column(DateTime, server_default=func.now())
+
+class ConversationState(Base):
+    # 回答待ちのユーザーだけが1行ずつ持つ（主キー検索で引く）
+    __tablename__ = 'conversation_states'
+    user_id = Column(String, primary_key=True)
+    flow_id = Column(Integer, nullable=False)
+    step = Column(Integer, nullable=False, default=0)
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
+
+class SurveyAnswer(Base):
+    __tablename__ = 'survey_answers'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    flow_id = Column(Integer, nullable=False)
+    user_id = Column(String, nullable=False)
+    question_index = Column(Integer, nullable=False)
+    answer = Column(String, nullable=False)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+    __table_args__ = (Index('ix_survey_answers_flow_question', 'flow_id', 'question_index'),)
+
+class MessageTemplate(Base):
+    __tablename__ = 'message_templates'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String, nullable=False)
+    # LINE API にそのまま渡す messages 配列（検証・変換済みのJSON）と、その SHA-256
+    payload = Column(Text, nullable=False)
+    payload_hash = Column(String(64), nullable=False, index=True)
+    message_count = Column(Integer, nullable=False)
+    created_at = Column(DateTime, server_default=func.now())
+
+class BatchRunLog(Base):
+    __tablename__ = 'batch_run_log'
+    id = Column(Integer, primary_key=True)
+    last_step_check_date = Column(DateTime, nullable=False)
+
+# --- エンジンとセッションの遅延生成 ---
+# コネクションプールは環境変数で調整できる（gunicorn のスレッド数 ≦ DB_POOL_SIZE + DB_MAX_OVERFLOW を目安にする）
+def get_pool_options():
+    return {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+    }
+
+_engine = None
+_engine_lock = threading.Lock()
+_session_factory = sessionmaker()
+
+def get_engine():
+    global _engine
+    if _engine is not None:
+        return _engine
+    with _engine_lock:
+        if _engine is None:
+            database_url = get_database_url()
+            # SQLite（ローカル開発用）はプール設定を受け付けないため既定のまま使う
+            pool_options = {} if database_url.startswith('sqlite') else get_pool_options()
+            engine = create_engine(database_url, pool_pre_ping=True, **pool_options)
+            create_tables(engine)
+            # 既存テーブルへの列・インデックスの追加は重いロックを取るため、ここでは行わない（migrate_schema を参照）
+            missing = missing_columns(engine)
+            if missing:
+                print(f"!!! DBに未追加の列があります（{', '.join(missing)}）。"
+                      "python core.py migrate を実行するか、バッチ(step_delivery.py)を起動してください。")
+            _session_factory.configure(bind=engine)
+            _engine = engine
+    return _engine
+
+def create_tables(engine):
+    # ないテーブルだけを作る。複数のワーカーが同時に起動すると作成が競合することがあるので、一度だけやり直す
+    try:
+        Base.metadata.create_all(engine)
+    except DBAPIError as e:
+        print(f"!!! テーブル作成が競合しました。やり直します: {e.orig}")
+        Base.metadata.create_all(engine)
+
+# --- スキーマの更新（python core.py migrate / バッチの起動時に実行する）---
+# create_all は既存のテーブルに列やインデックスを追加しないため、後から増やした分をここで補う
+# （追加する列は NULL 可のものに限る）。Webの各ワーカーでは実行しない。
+def missing_columns(engine):
+    inspector = inspect(engine)
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        missing.extend(f"{table.name}.{column.name}" for column in table.columns if column.name not in existing_columns)
+    return missing
+
+def _add_column(engine, table, column):
+    quote = engine.dialect.identifier_preparer.quote
+    column_type = column.type.compile(dialect=engine.dialect)
+    if_not_exists = 'IF NOT EXISTS ' if engine.dialect.name == 'postgresql' else ''
+    try:
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {quote(table.name)} ADD COLUMN {if_not_exists}{quote(column.name)} {column_type}"))
+        print(f"列を追加しました: {table.name}.{column.name}")
+    except DBAPIError:
+        # 他のプロセスが先に追加していれば問題ない
+        existing_columns = {c['name'] for c in inspect(engine).get_columns(table.name)}
+        if column.name not in existing_columns:
+            raise
+
+def _postgres_index_state(conn, name):
+    # None: なし / True: 使用可能 / False: CONCURRENTLY の作成が途中で失敗して無効のまま残っている
+    return conn.execute(text(
+        "SELECT i.indisvalid FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid WHERE c.relname = :name"
+    ), {'name': name}).scalar()
+
+def _create_index(engine, index):
+    if engine.dialect.name != 'postgresql':
+        index.create(engine, checkfirst=True)
+        return
+    # 大きなテーブル（messages など）への書き込みを止めないよう CONCURRENTLY で作る。
+    # CONCURRENTLY はトランザクションの外で実行する必要がある
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        state = _postgres_index_state(conn, index.name)
+        if state:
+            return
+        if state is False:
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {quote(index.name)}"))
+        columns = ', '.join(quote(column.name) for column in index.columns)
+        unique = 'UNIQUE ' if index.unique else ''
+        conn.execute(text(
+            f"CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS {quote(index.name)} ON {quote(index.table.name)} ({columns})"
+        ))
+        print(f"インデックスを作成しました: {index.name}")
+
+def _relax_removed_columns(engine, table, columns):
+    # モデルから外した NOT NULL の列が残っていると INSERT が失敗するため、NULL を許可する（列自体は消さない）
+    quote = engine.dialect.identifier_preparer.quote
+    for column in columns:
+        if column['name'] in table.columns or column['nullable'] or column.get('default') is not None:
+            continue
+        if engine.dialect.name != 'postgresql':
+            print(f"!!! {table.name}.{column['name']} は使われていませんが NOT NULL のままです。テーブルを作り直してください。")
+            continue
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {quote(table.name)} ALTER COLUMN {quote(column['name'])} DROP NOT NULL"))
+        print(f"使われなくなった列の NOT NULL を外しました: {table.name}.{column['name']}")
+
+def migrate_schema(engine):
+    create_tables(engine)
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        columns = inspector.get_columns(table.name)
+        _relax_removed_columns(engine, table, columns)
+        existing_columns = {column['name'] for column in columns}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            if not column.nullable:
+                print(f"!!! {table.name}.{column.name} は NOT NULL のため自動では追加できません。")
+                continue
+            _add_column(engine, table, column)
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            _create_index(engine, index)
+
+def _create_session():
+    get_engine()
+    return _session_factory()
+
+# スレッド（gevent の場合はグリーンレット）ごとに1つのセッションを使い回す。
+# Web側はリクエスト終了時の teardown で、バッチやバックグラウンド処理は処理の最後に Session.remove() を呼ぶ。
+Session = scoped_session(_create_session)
+
+# --- LINEの認証情報 ---
+# 管理画面の「各種設定」に保存された値を優先し、未設定の場合は環境変数を使う
+CREDENTIAL_ENV_VARS = {
+    'line_channel_access_token': 'LINE_CHANNEL_ACCESS_TOKEN',
+    'line_channel_secret': 'LINE_CHANNEL_SECRET',
+}
+
+def get_credential(key, session=None):
+    own_session = session is None
+    if own_session:
+        # 呼び出し元のスレッドローカルなセッションを閉じてしまわないよう、独立した短命のセッションを使う
+        session = _create_session()
+    try:
+        setting = session.query(Setting).filter_by(key=key).first()
+    finally:
+        if own_session:
+            session.close()
+    if setting and setting.value:
+        return setting.value
+    return os.environ.get(CREDENTIAL_ENV_VARS[key])
+
+def get_line_bot_api(session=None):
+    access_token = get_credential('line_channel_access_token', session)
+    if not access_token:
+        return None
+    # linebot は読み込みが重いため、実際に送信する時まで import しない
+    from linebot import LineBotApi
+    # LINE_API_ENDPOINT を指定するとローカルのスタブ（benchmarks/line_stub.py）へ送信できる
+    options = {'http_client': metrics.get_timed_http_client()}
+    endpoint = os.environ.get('LINE_API_ENDPOINT')
+    if endpoint:
+        options['endpoint'] = endpoint
+    return LineBotApi(access_token, **options)
+
+if __name__ == "__main__":
+    # 使い方: python core.py migrate （デプロイ時に、Webを新しい版へ切り替える前に1回実行する）
+    import sys
+    if sys.argv[1:] != ['migrate']:
+        print("使い方: python core.py migrate")
+        sys.exit(1)
+    if not get_database_url():
+        print("!!! エラー: DATABASE_URL が設定されていません。")
+        sys.exit(1)
+    migrate_schema(get_engine())
+    print("--- スキーマの更新が完了しました ---")
@@ -0,0 +1,117 @@
+import json
+import queue
+import threading
+import time
+
+from sqlalchemy import text
+
+# --- 管理画面へのリアルタイム通知（Server-Sent Events用のPub/Sub）---
+# 単一プロセス内ではメモリ上のキューで配信し、PostgreSQLの場合は
+# LISTEN/NOTIFY を経由して複数ワーカー・バッチプロセス間で共有する。
+NOTIFY_CHANNEL = 'line_bot_events'
+SUBSCRIBER_QUEUE_SIZE = 100
+# NOTIFYのペイロード上限(8000バイト)に収めるため、本文はプレビューだけを送る
+CONTENT_PREVIEW_LENGTH = 200
+
+
+class EventBroker:
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._listener = None
+        # 画面に流さずプロセス内で処理するイベント（キャッシュの無効化など）: {イベント種別: 関数}
+        self._handlers = {}
+        # LISTEN の（再）接続時に呼ぶ関数。切断中に届かなかった通知の埋め合わせに使う
+        self._connect_hooks = []
+
+    def add_handler(self, event_type, handler, on_connect=None):
+        with self._lock:
+            self._handlers[event_type] = handler
+            if on_connect is not None:
+                self._connect_hooks.append(on_connect)
+
+    def subscribe(self, engine=None):
+        if engine is not None and is_postgres(engine):
+            self.listen(engine)
+        subscriber = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish_local(self, event):
+        handler = self._handlers.get(event.get('type'))
+        if handler is not None:
+            handler(event['data'])
+            return
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                # 受信が追いつかない画面はイベントを取りこぼす（次回のリロードで整合する）
+                pass
+
+    def listen(self, engine):
+        with self._lock:
+            if self._listener is not None and self._listener.is_alive():
+                return
+            self._listener = threading.Thread(target=self._listen_forever, args=(engine,), daemon=True)
+            self._listener.start()
+
+    def _listen_forever(self, engine):
+        import psycopg
+        conninfo = engine.url.set(drivername='postgresql').render_as_string(hide_password=False)
+        while True:
+            try:
+                with psycopg.connect(conninfo, autocommit=True) as conn:
+                    conn.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                    for hook in list(self._connect_hooks):
+                        hook()
+                    for notify in conn.notifies():
+                        try:
+                            self.publish_local(json.loads(notify.payload))
+                        except json.JSONDecodeError:
+                            continue
+            except Exception as e:
+                print(f"!!! イベント受信(LISTEN)でエラー: {e}")
+                time.sleep(5)
+
+
+broker = EventBroker()
+
+
+def is_postgres(engine):
+    return engine.dialect.name == 'postgresql'
+
+
+def publish(engine, event_type, data):
+    event = {'type': event_type, 'data': data}
+    if not is_postgres(engine):
+        broker.publish_local(event)
+        return
+    # 自プロセスの購読者にもLISTEN経由で届くため、ここではローカル配信しない
+    try:
+        with engine.connect() as conn:
+            conn.execute(
+                text("SELECT pg_notify(:channel, :payload)"),
+                {'channel': NOTIFY_CHANNEL, 'payload': json.dumps(event, ensure_ascii=False)}
+            )
+            conn.commit()
+    except Exception as e:
+        print(f"!!! イベント通知(NOTIFY)でエラー: {e}")
+
+
+def preview(content):
+    # 長い本文は切り詰めて truncated を付ける（トーク画面は message_id で全文を取り直す）
+    truncated = bool(content) and len(content) > CONTENT_PREVIEW_LENGTH
+    return {'content': content[:CONTENT_PREVIEW_LENGTH] if truncated else content, 'truncated': truncated}
+
+
+def format_sse(event):
+    payload = json.dumps(event['data'], ensure_ascii=False)
+    return f"event: {event['type']}\ndata: {payload}\n\n"
@@ -0,0 +1,68 @@
+import csv
+import io
+import json
+import zlib
+from datetime import datetime
+
+# --- CSV / JSONL のストリーミング出力 ---
+# 行はサーバーサイドカーソルから少しずつ受け取り、一定行数ごとに書き出す。
+# gzip は zlib の圧縮オブジェクトでその場で圧縮するため、全体をメモリに載せない。
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+}
+FLUSH_EVERY_ROWS = 500
+
+
+def _serialize(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def iter_csv(columns, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # Excelで文字化けしないようBOMを付ける
+    buffer.write('\ufeff')
+    writer.writerow(columns)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(['' if value is None else _serialize(value) for value in row])
+        if count % FLUSH_EVERY_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def iter_jsonl(columns, rows):
+    lines = []
+    for row in rows:
+        record = {column: _serialize(value) for column, value in zip(columns, row)}
+        lines.append(json.dumps(record, ensure_ascii=False))
+        if len(lines) >= FLUSH_EVERY_ROWS:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def iter_export(fmt, columns, rows, use_gzip=False):
+    chunks = iter_csv(columns, rows) if fmt == 'csv' else iter_jsonl(columns, rows)
+    if not use_gzip:
+        for chunk in chunks:
+            yield chunk.encode('utf-8')
+        return
+    # wbits=31 で gzip ヘッダ付きのストリームを生成する
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk.encode('utf-8'))
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def accepts_gzip(request):
+    if request.args.get('gzip') is not None:
+        return request.args.get('gzip') != '0'
+    return 'gzip' in request.headers.get('Accept-Encoding', '')
@@ -0,0 +1,33 @@
+import os
+
+# --- gunicorn の起動設定 ---
+# Webhook(/callback)と管理画面を並行して捌けるよう、スレッドワーカー(gthread)で起動する。
+# DBセッションは core.Session（scoped_session）でスレッドごとに分離され、リクエスト終了時に main.remove_session が破棄する。
+# SSE(/admin/events)の接続は開いている間スレッドを1つ占有するため、main.py で同時接続数を
+# GUNICORN_THREADS - SSE_RESERVED_THREADS（SSE_MAX_SUBSCRIBERS で変更可）に制限している。
+# 管理画面を多数のタブで開く場合は GUNICORN_THREADS を増やすか、GUNICORN_WORKER_CLASS=gevent を使う。
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+keepalive = 5
+# 起動時に main をインポートしておく（DBへの接続は各ワーカーの最初のリクエスト時に行われる）
+preload_app = True
+
+def on_starting(server):
+    pool_size = int(os.environ.get('DB_POOL_SIZE', 5))
+    max_overflow = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+    # 1ワーカーが同時に使うコネクション数はスレッド数が上限になる
+    if worker_class == 'gthread' and threads > pool_size + max_overflow:
+        server.log.warning(
+            f"GUNICORN_THREADS({threads}) が DB_POOL_SIZE + DB_MAX_OVERFLOW({pool_size + max_overflow}) を超えています。"
+            "混雑時にコネクション待ちが発生します。"
+        )
+
+def worker_exit(server, worker):
+    # メモリに溜まっているアンケート回答を、ワーカー終了前に書き込む
+    import sys
+    surveys = sys.modules.get('surveys')
+    if surveys:
+        surveys.flush_pending_answers()
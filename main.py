@@ -3,26 +3,30 @@ import sys
 from functools import wraps
 from datetime import datetime, timezone, timedelta
 import json
-from flask import Flask, request, abort, render_template, redirect, url_for, Response, jsonify, send_from_directory
+import queue
+import threading
+import time
+from flask import Flask, request, abort, render_template, redirect, url_for, Response, jsonify, send_from_directory, stream_with_context
 from werkzeug.utils import secure_filename
 from uuid import uuid4
 from dotenv import load_dotenv
 
-from linebot import (
-    LineBotApi, WebhookHandler
-)
-from linebot.exceptions import (
-    InvalidSignatureError, LineBotApiError
-)
-from linebot.models import (
-    MessageEvent, TextMessage, TextSendMessage, FollowEvent,
-    QuickReply, QuickReplyButton, MessageAction, ImageSendMessage,
-    TemplateSendMessage, ButtonsTemplate, CarouselTemplate, CarouselColumn, URIAction,
-    ImagemapSendMessage, BaseSize, ImagemapArea, URIImagemapAction, MessageImagemapAction
-)
+from sqlalchemy import func, or_, select
 
-from sqlalchemy import create_engine, Column, String, DateTime, func, Integer, Text, or_, and_
-from sqlalchemy.orm import sessionmaker, declarative_base
+from core import (
+    get_database_url, get_engine, Session, get_credential, get_line_bot_api,
+    User, StepMessage, Setting, Tag, Message, ScheduledMessage, ScheduledBroadcast,
+    SurveyFlow, ConversationState, SurveyAnswer, MessageTemplate, DeliveryChunk
+)
+import events
+from exporter import EXPORT_FORMATS, iter_export, accepts_gzip
+import bulk_tags
+import surveys
+import broadcasts
+import message_templates
+import recurrence
+import metrics
+import cache
 
 # .envファイルをロード
 load_dotenv()
@@ -39,96 +43,47 @@ if not os.path.exists(UPLOAD_FOLDER):
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# 予約フォームで選べるタイムゾーン
+@app.context_processor
+def inject_schedule_options():
+    return {'timezone_choices': recurrence.TIMEZONE_CHOICES, 'default_timezone': recurrence.DEFAULT_TIMEZONE}
+
+# --- リクエストごとの計測（処理時間・SQL回数）---
+metrics.install_sql_hooks()
+
+def metrics_route_label():
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+@app.before_request
+def start_request_metrics():
+    metrics.start_request()
+
+@app.after_request
+def finish_request_metrics(response):
+    metrics.finish_request(request.method, metrics_route_label(), response.status_code)
+    return response
+
+@app.teardown_request
+def finish_failed_request_metrics(exception=None):
+    # 例外で after_request が呼ばれなかった場合だけ 500 として記録する
+    if exception is not None:
+        metrics.finish_request(request.method, metrics_route_label(), 500)
+
+# --- リクエスト単位のセッション管理 ---
+# エラーで途中 return した場合も含め、リクエストの終わりに必ずセッションを破棄してコネクションをプールへ返す
+@app.teardown_appcontext
+def remove_session(exception=None):
+    Session.remove()
+
 # --- 環境変数から設定を取得 ---
-db_url_from_env = os.environ.get('DATABASE_URL')
+# DBへの接続とテーブル作成は最初のリクエスト時に core.get_engine() が行う
 admin_username = os.environ.get('ADMIN_USERNAME')
 admin_password = os.environ.get('ADMIN_PASSWORD')
 
-if db_url_from_env and db_url_from_env.startswith("postgres://"):
-    database_url = db_url_from_env.replace("postgres://", "postgresql+psycopg://", 1)
-else:
-    database_url = db_url_from_env
-
-if not all([database_url, admin_username, admin_password]):
+if not all([get_database_url(), admin_username, admin_password]):
     print("!!! エラー: 必要な環境変数が設定されていません。")
     sys.exit(1)
 
-# --- データベースの設定 ---
-Base = declarative_base()
-class User(Base):
-    __tablename__ = 'users'
-    id = Column(String, primary_key=True)
-    display_name = Column(String)
-    nickname = Column(String)
-    tags = Column(String, default="")
-    status = Column(String, default="未対応")
-    sent_steps = Column(String, default="")
-    created_at = Column(DateTime, server_default=func.now())
-
-class StepMessage(Base):
-    __tablename__ = 'step_messages'
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    days_after = Column(Integer, nullable=False)
-    message_text = Column(Text, nullable=False)
-
-class Setting(Base):
-    __tablename__ = 'settings'
-    key = Column(String, primary_key=True)
-    value = Column(Text)
-
-class Tag(Base):
-    __tablename__ = 'tags'
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    name = Column(String, nullable=False, unique=True)
-
-class Message(Base):
-    __tablename__ = 'messages'
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(String, nullable=False)
-    sender_type = Column(String, nullable=False)
-    content = Column(Text, nullable=False)
-    created_at = Column(DateTime, server_default=func.now())
-
-class ScheduledMessage(Base):
-    __tablename__ = 'scheduled_messages'
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(String, nullable=False)
-    message_text = Column(Text, nullable=False)
-    send_at = Column(DateTime(timezone=True), nullable=False)
-    status = Column(String, default='pending')
-
-class ScheduledBroadcast(Base):
-    __tablename__ = 'scheduled_broadcasts'
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    name = Column(String, default="無題の配信")
-    targeting_info = Column(Text, nullable=False)
-    messages_info = Column(Text, nullable=False)
-    send_at = Column(DateTime(timezone=True), nullable=False)
-    status = Column(String, default='pending')
-
-class BatchRunLog(Base):
-    __tablename__ = 'batch_run_log'
-    id = Column(Integer, primary_key=True)
-    last_step_check_date = Column(DateTime, nullable=False)
-
-
-try:
-    engine = create_engine(database_url, pool_pre_ping=True)
-    Base.metadata.create_all(engine)
-    Session = sessionmaker(bind=engine)
-except Exception as e:
-    print(f"!!! データベース接続エラー: {e}")
-    sys.exit(1)
-
-# --- LINE APIのクライアントを動的に生成する関数 ---
-def get_line_bot_api():
-    session = Session()
-    access_token_setting = session.query(Setting).filter_by(key='line_channel_access_token').first()
-    session.close()
-    if access_token_setting and access_token_setting.value:
-        return LineBotApi(access_token_setting.value)
-    return None
-
 # --- ベーシック認証用のコード ---
 def check_auth(username, password):
     return username == admin_username and password == admin_password
@@ -181,25 +136,89 @@ def admin_friends_page():
 def admin_steps_page():
     session = Session()
     step_messages = session.query(StepMessage).order_by(StepMessage.days_after).all()
+    templates = message_templates.list_templates(session)
     session.close()
-    return render_template('steps.html', step_messages=step_messages)
+    template_names = {template['id']: template['name'] for template in templates}
+    for message in step_messages:
+        message.spread_text = spread_text(message)
+    return render_template('steps.html', step_messages=step_messages, templates=templates, template_names=template_names)
+
+# --- キャッシュする参照データ（書き込み側のルートで無効化する）---
+def load_tags():
+    session = Session()
+    return [{'id': tag.id, 'name': tag.name} for tag in session.query(Tag).order_by(Tag.name)]
+
+def load_pending_broadcasts():
+    session = Session()
+    # 送信中（分散配信・バッチに任せた即時送信）の配信も、送り終わるまで一覧に残す
+    scheduled_broadcasts = session.query(ScheduledBroadcast).filter(
+        ScheduledBroadcast.status.in_(('pending', 'sending'))
+    ).order_by(ScheduledBroadcast.send_at)
+    # 配信ごとの未送信・失敗した宛先の人数
+    chunk_counts = dict(
+        ((source_id, status), count or 0)
+        for source_id, status, count in session.query(
+            DeliveryChunk.source_id, DeliveryChunk.status, func.sum(DeliveryChunk.recipient_count)
+        ).filter(DeliveryChunk.source == 'broadcast').group_by(DeliveryChunk.source_id, DeliveryChunk.status)
+    )
+    return [{
+        'id': broadcast.id,
+        'name': broadcast.name,
+        'status': broadcast.status,
+        'send_at_text': recurrence.format_local(broadcast.send_at, broadcast.timezone),
+        'timezone': broadcast.timezone or recurrence.DEFAULT_TIMEZONE,
+        'recurrence': broadcast.recurrence,
+        'spread_text': spread_text(broadcast),
+        'remaining': chunk_counts.get((broadcast.id, 'pending'), 0),
+        'failed': chunk_counts.get((broadcast.id, 'error'), 0),
+    } for broadcast in scheduled_broadcasts]
+
+def load_failed_chunks(session):
+    # 再送の上限に達した分散配信のまとまり（管理画面から再送・破棄する）
+    chunks = session.query(DeliveryChunk).filter(DeliveryChunk.status == 'error').order_by(DeliveryChunk.send_after).all()
+    broadcast_names = dict(session.query(ScheduledBroadcast.id, ScheduledBroadcast.name).filter(
+        ScheduledBroadcast.id.in_({chunk.source_id for chunk in chunks if chunk.source == 'broadcast'})
+    ))
+    step_days = dict(session.query(StepMessage.id, StepMessage.days_after).filter(
+        StepMessage.id.in_({chunk.source_id for chunk in chunks if chunk.source == 'step'})
+    ))
+    failed = []
+    for chunk in chunks:
+        if chunk.source == 'step':
+            label = f"ステップ配信（登録{step_days.get(chunk.source_id, '?')}日後）"
+        else:
+            label = f"配信「{broadcast_names.get(chunk.source_id, '無題の配信')}」"
+        failed.append({
+            'id': chunk.id,
+            'label': label,
+            'recipient_count': chunk.recipient_count,
+            'attempts': chunk.attempts,
+            'last_error': chunk.last_error,
+        })
+    return failed
+
+def spread_text(row):
+    # 一覧に表示する分散配信の指定
+    parts = []
+    if row.spread_minutes:
+        parts.append(f"{row.spread_minutes}分かけて")
+    if row.max_per_minute:
+        parts.append(f"最大{row.max_per_minute}人/分")
+    return '・'.join(parts)
+
+def get_cached_tags():
+    return cache.get_or_load(cache.TAGS_KEY, load_tags)
 
 @app.route("/admin/messaging")
 @auth_required
 def admin_messaging_page():
+    all_tags = get_cached_tags()
+    scheduled_broadcasts = cache.get_or_load(cache.PENDING_BROADCASTS_KEY, load_pending_broadcasts)
     session = Session()
-    all_tags = session.query(Tag).order_by(Tag.name).all()
-    scheduled_broadcasts = session.query(ScheduledBroadcast).filter(
-        ScheduledBroadcast.status == 'pending'
-    ).order_by(ScheduledBroadcast.send_at).all()
-    
-    jst = timezone(timedelta(hours=9))
-    for broadcast in scheduled_broadcasts:
-        # DBから取得したUTC時刻を、正しくJSTに変換
-        broadcast.send_at_jst = broadcast.send_at.astimezone(jst)
-
-    session.close()
-    return render_template('messaging.html', tags=all_tags, broadcasts=scheduled_broadcasts)
+    templates = message_templates.list_templates(session)
+    failed_chunks = load_failed_chunks(session)
+    return render_template('messaging.html', tags=all_tags, broadcasts=scheduled_broadcasts, templates=templates,
+                           failed_chunks=failed_chunks)
     
 @app.route("/admin/tags", methods=['GET', 'POST'])
 @auth_required
@@ -213,10 +232,9 @@ def admin_tags_page():
                 new_tag = Tag(name=tag_name)
                 session.add(new_tag)
                 session.commit()
+                cache.invalidate(cache.TAGS_KEY, cache.TAGS_PAGE_KEY)
         return redirect(url_for('admin_tags_page'))
-    all_tags = session.query(Tag).order_by(Tag.name).all()
-    session.close()
-    return render_template('tags.html', tags=all_tags)
+    return cache.get_or_load(cache.TAGS_PAGE_KEY, lambda: render_template('tags.html', tags=get_cached_tags()))
 
 @app.route("/delete-tag/<int:tag_id>", methods=['POST'])
 @auth_required
@@ -226,6 +244,7 @@ def delete_tag(tag_id):
     if tag_to_delete:
         session.delete(tag_to_delete)
         session.commit()
+        cache.invalidate(cache.TAGS_KEY, cache.TAGS_PAGE_KEY)
     session.close()
     return redirect(url_for('admin_tags_page'))
 
@@ -288,14 +307,108 @@ def admin_chat_detail_page(user_id):
     scheduled_messages = session.query(ScheduledMessage).filter_by(
         user_id=user_id, status='pending'
     ).order_by(ScheduledMessage.send_at).all()
+    for msg in scheduled_messages:
+        msg.send_at_text = recurrence.format_local(msg.send_at, msg.timezone)
     session.close()
     if not user:
         return "ユーザーが見つかりません。", 404
     return render_template('chat_detail.html', user=user, messages=messages, scheduled_messages=scheduled_messages)
 
+@app.route("/admin/chat/<user_id>/messages/<int:message_id>")
+@auth_required
+def chat_message_content(user_id, message_id):
+    # 通知では本文が切り詰められるため、トーク画面が全文を取り直すのに使う
+    session = Session()
+    message = session.query(Message).filter_by(id=message_id, user_id=user_id).first()
+    content = message.content if message else None
+    session.close()
+    if content is None:
+        return jsonify({'status': 'error', 'message': 'メッセージが見つかりません。'}), 404
+    return jsonify({'content': content})
+
+# --- 管理画面へのリアルタイム配信（Server-Sent Events）---
+# gthread ワーカーでは、開いている接続1本がスレッドを1つ占有し続ける。管理画面のタブが増えても
+# /callback や他の画面を処理するスレッドが残るよう、同時接続数に上限を設ける。
+# 上限を超えた接続にはすぐに閉じて、EventSource に SSE_BUSY_RETRY_MS 後の再接続を指示する。
+# 1本の接続も SSE_MAX_CONNECTION_SECONDS で閉じ、空いた枠を順番に使えるようにする。
+SSE_KEEPALIVE_SECONDS = 15
+SSE_RESERVED_THREADS = 4
+SSE_MAX_CONNECTION_SECONDS = 300
+SSE_BUSY_RETRY_MS = 30000
+
+def default_sse_limit():
+    # gevent などの非同期ワーカーは接続ごとにスレッドを使わないため、上限を設けない
+    if os.environ.get('GUNICORN_WORKER_CLASS', 'gthread') != 'gthread':
+        return None
+    threads = int(os.environ.get('GUNICORN_THREADS', 8))
+    return max(1, threads - SSE_RESERVED_THREADS)
+
+SSE_MAX_SUBSCRIBERS = int(os.environ['SSE_MAX_SUBSCRIBERS']) if os.environ.get('SSE_MAX_SUBSCRIBERS') else default_sse_limit()
+_sse_connections = 0
+_sse_lock = threading.Lock()
+
+def acquire_sse_slot():
+    global _sse_connections
+    with _sse_lock:
+        if SSE_MAX_SUBSCRIBERS is not None and _sse_connections >= SSE_MAX_SUBSCRIBERS:
+            return False
+        _sse_connections += 1
+        return True
+
+def release_sse_slot():
+    global _sse_connections
+    with _sse_lock:
+        _sse_connections -= 1
+
+@app.route("/admin/events")
+@auth_required
+def admin_events_stream():
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    if not acquire_sse_slot():
+        metrics.sse_rejected.inc()
+        return Response(f"retry: {SSE_BUSY_RETRY_MS}\n\n", mimetype='text/event-stream', headers=headers)
+    try:
+        subscriber = events.broker.subscribe(get_engine())
+    except Exception:
+        release_sse_slot()
+        raise
+
+    def generate():
+        yield "retry: 5000\n\n"
+        deadline = time.monotonic() + SSE_MAX_CONNECTION_SECONDS
+        while time.monotonic() < deadline:
+            try:
+                event = subscriber.get(timeout=SSE_KEEPALIVE_SECONDS)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            yield events.format_sse(event)
+
+    def close():
+        # 最初の送信前に切断された場合も、サーバーが close() を呼ぶので枠を必ず返せる
+        events.broker.unsubscribe(subscriber)
+        release_sse_slot()
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream', headers=headers)
+    response.call_on_close(close)
+    return response
+
+def publish_message_event(user_id, user, message_id, content, sender_type):
+    events.publish(get_engine(), 'message', {
+        'user_id': user_id,
+        'message_id': message_id,
+        'display_name': (user.nickname or user.display_name) if user else None,
+        'status': user.status if user else None,
+        'sender_type': sender_type,
+        **events.preview(content),
+        'created_at': datetime.now(timezone.utc).strftime('%m-%d %H:%M'),
+    })
+
 @app.route("/admin/chat/<user_id>/send", methods=['POST'])
 @auth_required
 def send_reply(user_id):
+    from linebot.exceptions import LineBotApiError
+    from linebot.models import TextSendMessage
     line_bot_api = get_line_bot_api()
     if not line_bot_api: return "アクセストークンが設定されていません。", 500
     reply_text = request.form.get('message_text')
@@ -310,7 +423,10 @@ def send_reply(user_id):
     new_message = Message(user_id=user_id, sender_type='admin', content=reply_text)
     session.add(new_message)
     session.commit()
+    message_id = new_message.id
+    user = session.query(User).filter_by(id=user_id).first()
     session.close()
+    publish_message_event(user_id, user, message_id, reply_text, 'admin')
     return redirect(url_for('admin_chat_detail_page', user_id=user_id))
     
 @app.route("/admin/chat/<user_id>/schedule", methods=['POST'])
@@ -320,22 +436,22 @@ def schedule_reply(user_id):
     send_at_str = request.form.get('send_at')
     if not message_text or not send_at_str:
         return redirect(url_for('admin_chat_detail_page', user_id=user_id))
-    
-    try:
-        naive_dt = datetime.strptime(send_at_str, '%Y-%m-%d %H:%M')
-    except ValueError:
-        return "日時の形式が正しくありません。", 400
 
-    jst = timezone(timedelta(hours=9))
-    jst_dt = naive_dt.replace(tzinfo=jst)
-    utc_dt = jst_dt.astimezone(timezone.utc)
+    tz_name = request.form.get('timezone') or recurrence.DEFAULT_TIMEZONE
+    try:
+        send_at = recurrence.parse_local(send_at_str, tz_name)
+        recurrence_rule = recurrence.normalize(request.form.get('recurrence'))
+    except recurrence.RecurrenceError as e:
+        return str(e), 400
 
     session = Session()
     new_scheduled_message = ScheduledMessage(
         user_id=user_id,
         message_text=message_text,
-        send_at=utc_dt,
-        status='pending'
+        send_at=send_at,
+        status='pending',
+        recurrence=recurrence_rule,
+        timezone=tz_name
     )
     session.add(new_scheduled_message)
     session.commit()
@@ -351,28 +467,23 @@ def edit_scheduled_page(msg_id):
         session.close()
         return "メッセージが見つかりません。", 404
 
-    user_id_for_redirect = message_to_edit.user_id
-    jst = timezone(timedelta(hours=9))
-    
     if request.method == 'POST':
         message_to_edit.message_text = request.form.get('message_text')
+        tz_name = request.form.get('timezone') or message_to_edit.timezone or recurrence.DEFAULT_TIMEZONE
         send_at_str = request.form.get('send_at')
-        if send_at_str:
-            try:
-                naive_dt = datetime.strptime(send_at_str, '%Y-%m-%d %H:%M')
-                jst_dt = naive_dt.replace(tzinfo=jst)
-                utc_dt = jst_dt.astimezone(timezone.utc)
-                message_to_edit.send_at = utc_dt
-            except ValueError:
-                return "日時の形式が正しくありません。", 400
+        try:
+            if send_at_str:
+                message_to_edit.send_at = recurrence.parse_local(send_at_str, tz_name)
+            message_to_edit.recurrence = recurrence.normalize(request.form.get('recurrence'))
+        except recurrence.RecurrenceError as e:
+            session.close()
+            return jsonify({'status': 'error', 'message': str(e)})
+        message_to_edit.timezone = tz_name
         session.commit()
         session.close()
         return jsonify({'status': 'success'})
 
-    utc_dt = message_to_edit.send_at.replace(tzinfo=timezone.utc)
-    jst_dt = utc_dt.astimezone(jst)
-    message_to_edit.send_at_jst = jst_dt
-    
+    message_to_edit.send_at_text = recurrence.format_local(message_to_edit.send_at, message_to_edit.timezone)
     session.close()
     return render_template('edit_scheduled.html', message=message_to_edit)
 
@@ -390,6 +501,11 @@ def delete_scheduled(msg_id):
         return redirect(url_for('admin_chat_detail_page', user_id=user_id_for_redirect))
     return redirect(url_for('admin_chat_page'))
 
+def broadcast_text_is_editable(messages_info):
+    # テキスト1通だけの配信のみ、管理画面から本文を編集できる（テンプレートを使う配信は対象外）
+    payload = messages_info.get('payload') or []
+    return len(payload) == 1 and payload[0].get('type') == 'text'
+
 @app.route("/edit-broadcast/<int:broadcast_id>", methods=['GET', 'POST'])
 @auth_required
 def edit_broadcast_page(broadcast_id):
@@ -399,43 +515,46 @@ def edit_broadcast_page(broadcast_id):
         session.close()
         return "予約配信が見つかりません。", 404
 
-    jst = timezone(timedelta(hours=9))
+    try:
+        messages_info = json.loads(broadcast_to_edit.messages_info)
+    except json.JSONDecodeError:
+        messages_info = {}
+
     if request.method == 'POST':
         broadcast_to_edit.name = request.form.get('name')
+        tz_name = request.form.get('timezone') or broadcast_to_edit.timezone or recurrence.DEFAULT_TIMEZONE
         send_at_str = request.form.get('send_at')
-        if send_at_str:
-            try:
-                naive_dt = datetime.strptime(send_at_str, '%Y-%m-%d %H:%M')
-                jst_dt = naive_dt.replace(tzinfo=jst)
-                utc_dt = jst_dt.astimezone(timezone.utc)
-                broadcast_to_edit.send_at = utc_dt
-            except ValueError:
-                return "日時の形式が正しくありません。", 400
-        
-        messages_info = json.loads(broadcast_to_edit.messages_info)
+        try:
+            if send_at_str:
+                broadcast_to_edit.send_at = recurrence.parse_local(send_at_str, tz_name)
+            broadcast_to_edit.recurrence = recurrence.normalize(request.form.get('recurrence'))
+            broadcast_to_edit.spread_minutes, broadcast_to_edit.max_per_minute = broadcasts.parse_spread(request.form)
+        except (recurrence.RecurrenceError, broadcasts.SpreadError) as e:
+            session.close()
+            return jsonify({'status': 'error', 'message': str(e)})
+        broadcast_to_edit.timezone = tz_name
+
         new_text = request.form.get('message_text')
-        if 'text_contents' in messages_info and new_text is not None:
-            if messages_info['text_contents']:
-                messages_info['text_contents'][0] = new_text
-            else:
-                 messages_info['text_contents'].append(new_text)
-            broadcast_to_edit.messages_info = json.dumps(messages_info)
+        if new_text is not None and broadcast_text_is_editable(messages_info):
+            payload = [dict(messages_info['payload'][0], text=new_text)]
+            try:
+                message_templates.validate_payload(payload)
+            except message_templates.TemplateError as e:
+                session.close()
+                return jsonify({'status': 'error', 'message': str(e)})
+            messages_info['payload'] = payload
+            broadcast_to_edit.messages_info = json.dumps(messages_info, ensure_ascii=False)
 
         session.commit()
         session.close()
+        cache.invalidate(cache.PENDING_BROADCASTS_KEY)
         return jsonify({'status': 'success'})
 
-    broadcast_to_edit.send_at_jst = broadcast_to_edit.send_at.astimezone(jst)
-    
-    try:
-        messages_info = json.loads(broadcast_to_edit.messages_info)
-        if messages_info.get('message_types') and messages_info.get('text_contents'):
-            broadcast_to_edit.message_text = messages_info.get('text_contents')[0]
-        else:
-            broadcast_to_edit.message_text = "(画像やカルーセルを含むため、編集できません)"
-    except (json.JSONDecodeError, IndexError):
-        broadcast_to_edit.message_text = ""
-
+    broadcast_to_edit.send_at_text = recurrence.format_local(broadcast_to_edit.send_at, broadcast_to_edit.timezone)
+    if broadcast_text_is_editable(messages_info):
+        broadcast_to_edit.message_text = messages_info['payload'][0]['text']
+    else:
+        broadcast_to_edit.message_text = None
     session.close()
     return render_template('edit_broadcast.html', broadcast=broadcast_to_edit)
 
@@ -446,7 +565,39 @@ def delete_broadcast(broadcast_id):
     broadcast_to_delete = session.query(ScheduledBroadcast).filter_by(id=broadcast_id).first()
     if broadcast_to_delete:
         session.delete(broadcast_to_delete)
+        broadcasts.cancel_spread(session, 'broadcast', broadcast_id)
+        session.commit()
+        cache.invalidate(cache.PENDING_BROADCASTS_KEY)
+    session.close()
+    return redirect(url_for('admin_messaging_page'))
+
+@app.route("/retry-chunk/<int:chunk_id>", methods=['POST'])
+@auth_required
+def retry_chunk(chunk_id):
+    session = Session()
+    chunk = session.query(DeliveryChunk).filter_by(id=chunk_id, status='error').first()
+    if chunk:
+        chunk.status = 'pending'
+        chunk.attempts = 0
+        chunk.send_after = datetime.now(timezone.utc)
         session.commit()
+        cache.invalidate(cache.PENDING_BROADCASTS_KEY)
+    session.close()
+    return redirect(url_for('admin_messaging_page'))
+
+@app.route("/discard-chunk/<int:chunk_id>", methods=['POST'])
+@auth_required
+def discard_chunk(chunk_id):
+    session = Session()
+    chunk = session.query(DeliveryChunk).filter_by(id=chunk_id, status='error').first()
+    if chunk:
+        source, source_id = chunk.source, chunk.source_id
+        session.delete(chunk)
+        session.flush()
+        if source == 'broadcast' and source_id:
+            broadcasts.finish_queued_broadcast(session, source_id)
+        session.commit()
+        cache.invalidate(cache.PENDING_BROADCASTS_KEY)
     session.close()
     return redirect(url_for('admin_messaging_page'))
 
@@ -459,6 +610,7 @@ def update_status(user_id):
     if user and new_status:
         user.status = new_status
         session.commit()
+        events.publish(get_engine(), 'status', {'user_id': user_id, 'status': new_status})
     session.close()
     return redirect(url_for('admin_chat_detail_page', user_id=user_id))
 
@@ -467,8 +619,8 @@ def update_status(user_id):
 def edit_user_page(user_id):
     session = Session()
     user = session.query(User).filter_by(id=user_id).first()
-    all_tags = session.query(Tag).all()
     session.close()
+    all_tags = get_cached_tags()
     if not user:
         return "ユーザーが見つかりません。", 404
     return render_template('edit_user.html', user=user, all_tags=all_tags)
@@ -490,10 +642,18 @@ def update_user(user_id):
 @auth_required
 def add_step():
     days_after = request.form.get('days_after', type=int)
-    message_text = request.form.get('message_text')
-    if days_after is not None and message_text:
+    message_text = request.form.get('message_text') or ''
+    template_id = request.form.get('template_id', type=int)
+    try:
+        spread_minutes, max_per_minute = broadcasts.parse_spread(request.form)
+    except broadcasts.SpreadError as e:
+        return str(e), 400
+    if days_after is not None and (message_text or template_id):
         session = Session()
-        new_step = StepMessage(days_after=days_after, message_text=message_text)
+        new_step = StepMessage(
+            days_after=days_after, message_text=message_text, template_id=template_id,
+            spread_minutes=spread_minutes, max_per_minute=max_per_minute
+        )
         session.add(new_step)
         session.commit()
         session.close()
@@ -506,38 +666,177 @@ def delete_step(step_id):
     step_to_delete = session.query(StepMessage).filter_by(id=step_id).first()
     if step_to_delete:
         session.delete(step_to_delete)
+        broadcasts.cancel_spread(session, 'step', step_id)
         session.commit()
     session.close()
     return redirect(url_for('admin_steps_page'))
 
-def build_messages_from_form(request_form, request_files):
-    messages_to_send = []
-    message_types = request_form.getlist('message_type')
-    text_contents = request_form.getlist('text_content')
-    uploaded_files = request_files
-    imagemap_alt_texts = request_form.getlist('imagemap_alt_text')
-    imagemap_action_types = request_form.getlist('imagemap_action_type')
-    imagemap_action_data = request_form.getlist('imagemap_action_data')
-    button_titles = request_form.getlist('button_title')
-    button_texts = request_form.getlist('button_text')
-    carousel_alt_texts = request_form.getlist('carousel_alt_text')
-    action_message_indices = request_form.getlist('action_message_index', type=int)
-    action_labels = request_form.getlist('action_label')
-    action_types = request_form.getlist('action_type')
-    action_data = request_form.getlist('action_data')
-    column_message_indices = request_form.getlist('column_message_index', type=int)
-    column_titles = request_form.getlist('column_title')
-    column_texts = request_form.getlist('column_text')
-    column_image_urls = request_form.getlist('column_image_url')
-    action_column_indices = request_form.getlist('action_column_index', type=int)
-    text_idx, file_idx, button_idx, carousel_idx, imagemap_idx, action_idx, column_idx = 0, 0, 0, 0, 0, 0, 0
-    for i, msg_type in enumerate(message_types):
-        if len(messages_to_send) >= 5: break
-        if msg_type == 'text':
-            if text_idx < len(text_contents) and text_contents[text_idx]:
-                messages_to_send.append(TextSendMessage(text=text_contents[text_idx]))
-            text_idx += 1
-        elif msg_type == 'image' or msg_type == 'imagemap':
+# --- タグの一括付与・削除（CSV / JSONL）---
+@app.route("/admin/bulk-tags", methods=['GET', 'POST'])
+@auth_required
+def admin_bulk_tags_page():
+    if request.method == 'GET':
+        return render_template('bulk_tags.html')
+
+    # 管理画面からのファイルアップロードと、APIからの本文直接送信の両方を受け付ける
+    upload = request.files.get('file')
+    if upload and upload.filename:
+        data = upload.read()
+        fmt = request.form.get('format') or bulk_tags.detect_format(upload.filename, upload.mimetype)
+    else:
+        data = request.get_data()
+        fmt = request.args.get('format') or bulk_tags.detect_format(None, request.content_type)
+    try:
+        raw_text = bulk_tags.decode_upload(data)
+        if not raw_text.strip():
+            return jsonify({'status': 'error', 'message': 'データが空です。'}), 400
+        records = bulk_tags.parse_records(raw_text, fmt)
+    except bulk_tags.BulkTagError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+    create_missing = request.values.get('create_missing_users') in ('1', 'on', 'true')
+    job = bulk_tags.start_job(Session(), records, create_missing)
+    return jsonify({
+        'status': 'accepted',
+        'job': job,
+        'status_url': url_for('bulk_tags_job_status', job_id=job['id']),
+    }), 202
+
+@app.route("/admin/bulk-tags/jobs/<job_id>")
+@auth_required
+def bulk_tags_job_status(job_id):
+    job = bulk_tags.get_job(Session(), job_id)
+    if not job:
+        return jsonify({'status': 'error', 'message': 'ジョブが見つかりません。'}), 404
+    return jsonify(job)
+
+# --- アンケート（会話フロー）---
+@app.route("/admin/surveys", methods=['GET', 'POST'])
+@auth_required
+def admin_surveys_page():
+    session = Session()
+    if request.method == 'POST':
+        name = request.form.get('name', '').strip()
+        trigger_keyword = request.form.get('trigger_keyword', '').strip()
+        completion_message = request.form.get('completion_message', '').strip() or 'ご回答ありがとうございました！'
+        if not name or not trigger_keyword:
+            return "フロー名と開始キーワードを入力してください。", 400
+        try:
+            questions = surveys.parse_questions(request.form.get('questions', ''))
+            surveys.create_flow(session, name, trigger_keyword, questions, completion_message)
+        except surveys.SurveyError as e:
+            return str(e), 400
+        return redirect(url_for('admin_surveys_page'))
+
+    surveys.ensure_default_flow(session)
+    flows = session.query(SurveyFlow).order_by(SurveyFlow.id).all()
+    # 回答の集計（フロー・質問・選択肢ごとの件数）
+    answer_counts = {}
+    rows = session.query(
+        SurveyAnswer.flow_id, SurveyAnswer.question_index, SurveyAnswer.answer, func.count()
+    ).group_by(SurveyAnswer.flow_id, SurveyAnswer.question_index, SurveyAnswer.answer)
+    for flow_id, question_index, answer, count in rows:
+        answer_counts[(flow_id, question_index, answer)] = count
+    waiting_counts = dict(session.query(ConversationState.flow_id, func.count()).filter(
+        ConversationState.expires_at > datetime.now(timezone.utc)
+    ).group_by(ConversationState.flow_id).all())
+    flow_views = [{
+        'flow': flow,
+        'questions': json.loads(flow.questions),
+        'waiting': waiting_counts.get(flow.id, 0),
+    } for flow in flows]
+    session.close()
+    return render_template('surveys.html', flows=flow_views, answer_counts=answer_counts)
+
+@app.route("/toggle-survey/<int:flow_id>", methods=['POST'])
+@auth_required
+def toggle_survey(flow_id):
+    session = Session()
+    flow = session.query(SurveyFlow).filter_by(id=flow_id).first()
+    if flow:
+        flow.is_active = not flow.is_active
+        session.commit()
+        cache.invalidate(cache.SURVEY_FLOWS_KEY)
+    session.close()
+    return redirect(url_for('admin_surveys_page'))
+
+@app.route("/delete-survey/<int:flow_id>", methods=['POST'])
+@auth_required
+def delete_survey(flow_id):
+    session = Session()
+    flow = session.query(SurveyFlow).filter_by(id=flow_id).first()
+    if flow:
+        session.query(ConversationState).filter_by(flow_id=flow_id).delete(synchronize_session=False)
+        session.query(SurveyAnswer).filter_by(flow_id=flow_id).delete(synchronize_session=False)
+        session.delete(flow)
+        session.commit()
+        cache.invalidate(cache.SURVEY_FLOWS_KEY)
+    session.close()
+    return redirect(url_for('admin_surveys_page'))
+
+# --- データのエクスポート（CSV / JSONL）---
+EXPORT_YIELD_PER = 1000
+
+def stream_export(statement, columns, fmt, filename):
+    use_gzip = accepts_gzip(request)
+
+    def generate():
+        # サーバーサイドカーソルで少しずつ読み出し、メモリ使用量を一定に保つ
+        session = Session()
+        try:
+            result = session.execute(statement.execution_options(yield_per=EXPORT_YIELD_PER))
+            yield from iter_export(fmt, columns, result, use_gzip=use_gzip)
+        finally:
+            session.close()
+
+    headers = {'Content-Disposition': f'attachment; filename="{filename}.{fmt}"'}
+    if use_gzip:
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(generate()), mimetype=EXPORT_FORMATS[fmt], headers=headers)
+
+def parse_jst_date(date_str):
+    jst = timezone(timedelta(hours=9))
+    jst_dt = datetime.strptime(date_str, '%Y-%m-%d').replace(tzinfo=jst)
+    # messages.created_at はタイムゾーンなしのUTCで保存されている
+    return jst_dt.astimezone(timezone.utc).replace(tzinfo=None)
+
+@app.route("/admin/export/users.<fmt>")
+@auth_required
+def export_users(fmt):
+    if fmt not in EXPORT_FORMATS:
+        return "対応していない形式です。", 400
+    columns = ['id', 'display_name', 'nickname', 'tags', 'status', 'created_at']
+    statement = select(
+        User.id, User.display_name, User.nickname, User.tags, User.status, User.created_at
+    ).order_by(User.created_at)
+    return stream_export(statement, columns, fmt, 'users')
+
+@app.route("/admin/export/messages.<fmt>")
+@auth_required
+def export_messages(fmt):
+    if fmt not in EXPORT_FORMATS:
+        return "対応していない形式です。", 400
+    columns = ['id', 'user_id', 'sender_type', 'content', 'created_at']
+    statement = select(Message.id, Message.user_id, Message.sender_type, Message.content, Message.created_at)
+    user_id = request.args.get('user_id')
+    date_from = request.args.get('from')
+    date_to = request.args.get('to')
+    if user_id:
+        statement = statement.where(Message.user_id == user_id)
+    try:
+        if date_from:
+            statement = statement.where(Message.created_at >= parse_jst_date(date_from))
+        if date_to:
+            statement = statement.where(Message.created_at < parse_jst_date(date_to) + timedelta(days=1))
+    except ValueError:
+        return "日付の形式が正しくありません。", 400
+    return stream_export(statement.order_by(Message.id), columns, fmt, 'messages')
+
+def save_uploaded_images(request_form, request_files):
+    # 画像・イメージマップの添付ファイルを保存し、{'image_file_<番号>': ファイル名} を返す
+    image_files = {}
+    for i, msg_type in enumerate(request_form.getlist('message_type')):
+        if msg_type in ['image', 'imagemap']:
             file_key = f'image_file_{i}'
             if file_key in request_files:
                 file = request_files[file_key]
@@ -545,104 +844,70 @@ def build_messages_from_form(request_form, request_files):
                     filename = secure_filename(f"{uuid4().hex}.png")
                     filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
                     file.save(filepath)
-                    image_url = url_for('uploaded_file', filename=filename, _external=True)
-                    if '127.0.0.1' in image_url or 'localhost' in image_url:
-                        ngrok_url = os.environ.get('NGROK_URL')
-                        if ngrok_url:
-                            image_url = ngrok_url + url_for('uploaded_file', filename=filename)
-                        else:
-                             image_url = image_url.replace('http://', 'https://')
-                    
-                    if msg_type == 'image':
-                        messages_to_send.append(ImageSendMessage(original_content_url=image_url, preview_image_url=image_url))
-                    else:
-                        alt_text = imagemap_alt_texts[imagemap_idx] if imagemap_idx < len(imagemap_alt_texts) else "画像メッセージ"
-                        action_type = imagemap_action_types[imagemap_idx] if imagemap_idx < len(imagemap_action_types) else 'message'
-                        action_data = imagemap_action_data[imagemap_idx] if imagemap_idx < len(imagemap_action_data) else ''
-                        action = None
-                        area = ImagemapArea(x=0, y=0, width=1040, height=1040)
-                        if action_type == 'uri' and action_data.startswith('http'):
-                            action = URIImagemapAction(link_uri=action_data, area=area)
-                        elif action_type == 'message' and action_data:
-                             action = MessageImagemapAction(text=action_data, area=area)
-                        if action:
-                            message = ImagemapSendMessage(base_url=image_url, alt_text=alt_text, base_size=BaseSize(height=1040, width=1040), actions=[action])
-                            messages_to_send.append(message)
-                        imagemap_idx += 1
-            file_idx += 1
-        elif msg_type == 'button':
-            actions = []
-            num_actions = action_message_indices.count(i)
-            for _ in range(num_actions):
-                 if len(actions) >= 4: break
-                 if action_idx < len(action_labels):
-                    label = action_labels[action_idx]
-                    action_type = action_types[action_idx]
-                    data = action_data[action_idx]
-                    if action_type == 'uri' and data.startswith('http'): actions.append(URIAction(label=label, uri=data))
-                    elif action_type == 'message': actions.append(MessageAction(label=label, text=data))
-                 action_idx += 1
-            if actions:
-                template = ButtonsTemplate(
-                    title=button_titles[button_idx] if button_idx < len(button_titles) and button_titles[button_idx] else None,
-                    text=button_texts[button_idx] if button_idx < len(button_texts) else " ",
-                    actions=actions
-                )
-                messages_to_send.append(TemplateSendMessage(alt_text='ボタンメッセージ', template=template))
-            button_idx += 1
-        elif msg_type == 'carousel':
-            columns = []
-            num_columns = column_message_indices.count(i)
-            for _ in range(num_columns):
-                if len(columns) >= 10: break
-                actions = []
-                num_actions = action_column_indices.count(column_idx)
-                for _ in range(num_actions):
-                    if len(actions) >= 3: break
-                    if action_idx < len(action_labels):
-                        label = action_labels[action_idx]
-                        action_type = action_types[action_idx]
-                        data = action_data[action_idx]
-                        if action_type == 'uri' and data.startswith('http'): actions.append(URIAction(label=label, uri=data))
-                        elif action_type == 'message': actions.append(MessageAction(label=label, text=data))
-                    action_idx += 1
-                column = CarouselColumn(
-                    thumbnail_image_url=column_image_urls[column_idx] if column_idx < len(column_image_urls) and column_image_urls[column_idx] else None,
-                    title=column_titles[column_idx] if column_idx < len(column_titles) else None,
-                    text=column_texts[column_idx] if column_idx < len(column_texts) else " ",
-                    actions=actions
-                )
-                columns.append(column)
-                column_idx += 1
-            if columns:
-                alt_text = carousel_alt_texts[carousel_idx] if carousel_idx < len(carousel_alt_texts) and carousel_alt_texts[carousel_idx] else "カルーセル"
-                template = CarouselTemplate(columns=columns)
-                messages_to_send.append(TemplateSendMessage(alt_text=alt_text, template=template))
-            carousel_idx += 1
-    return messages_to_send
+                    image_files[file_key] = filename
+    return image_files
+
+def request_base_url():
+    # 画像はLINEのサーバーから取得されるため、外部から届くURLにする
+    base_url = broadcasts.public_base_url()
+    if base_url:
+        return base_url
+    base_url = request.url_root.rstrip('/')
+    if '127.0.0.1' in base_url or 'localhost' in base_url:
+        return base_url.replace('http://', 'https://')
+    return base_url
+
+def resolve_message_payload(session):
+    # 保存済みテンプレートが選ばれていればそのJSONを、なければフォームの内容を検証・変換して使う
+    template_id = request.form.get('template_id', type=int)
+    if template_id:
+        template = message_templates.get_template(session, template_id)
+        if not template:
+            raise message_templates.TemplateError("テンプレートが見つかりません。")
+        return template_id, template['payload']
+    image_files = save_uploaded_images(request.form, request.files)
+    return None, message_templates.compile_form(request.form, image_files, request_base_url())
+
+def targeting_info_from_form(form):
+    return {
+        'targeting_type': form.get('targeting_type'),
+        'include_tags': form.getlist('include_tags'),
+        'exclude_tags': form.getlist('exclude_tags'),
+    }
 
 @app.route("/send-message-from-admin", methods=['POST'])
 @auth_required
 def send_message_from_admin():
+    from linebot.exceptions import LineBotApiError
     line_bot_api = get_line_bot_api()
     if not line_bot_api: return "アクセストークンが設定されていません。", 500
-    targeting_type = request.form.get('targeting_type')
-    include_tags = request.form.getlist('include_tags')
-    exclude_tags = request.form.getlist('exclude_tags')
     session = Session()
-    query = session.query(User)
-    if targeting_type == 'segmented' and (include_tags or exclude_tags):
-        if include_tags: query = query.filter(and_(*[User.tags.like(f'%{tag}%') for tag in include_tags]))
-        if exclude_tags: query = query.filter(and_(*[User.tags.notlike(f'%{tag}%') for tag in exclude_tags]))
-    users = query.all()
-    user_ids = [user.id for user in users]
+    try:
+        _, payload = resolve_message_payload(session)
+        spread_minutes, max_per_minute = broadcasts.parse_spread(request.form)
+    except (message_templates.TemplateError, broadcasts.SpreadError) as e:
+        session.close()
+        return str(e), 400
+    users = broadcasts.select_recipients(
+        session,
+        request.form.get('targeting_type'),
+        request.form.getlist('include_tags'),
+        request.form.getlist('exclude_tags')
+    )
+    if users and (spread_minutes or max_per_minute or broadcasts.count_api_calls(users, payload) > broadcasts.INLINE_SEND_MAX_CALLS):
+        # 分散配信と、呼び出し回数の多い即時送信はバッチが送る（一覧に「送信中」として表示され、停止できる）
+        broadcasts.queue_broadcast(
+            session, request.form.get('broadcast_name'), targeting_info_from_form(request.form), payload, users,
+            spread_minutes, max_per_minute
+        )
+        session.commit()
+        session.close()
+        cache.invalidate(cache.PENDING_BROADCASTS_KEY)
+        return redirect(url_for('admin_messaging_page'))
     session.close()
-    if not user_ids: return redirect(url_for('admin_messaging_page'))
-    messages_to_send = build_messages_from_form(request.form, request.files)
-    if user_ids and messages_to_send:
+    if users:
         try:
-            for i in range(0, len(user_ids), 150):
-                line_bot_api.multicast(user_ids[i:i+150], messages_to_send)
+            broadcasts.deliver(line_bot_api, users, payload)
         except LineBotApiError as e:
             print(f"!!! 配信でエラー: {e}")
     return redirect(url_for('admin_messaging_page'))
@@ -650,57 +915,92 @@ def send_message_from_admin():
 @app.route("/schedule-message-from-admin", methods=['POST'])
 @auth_required
 def schedule_broadcast_from_admin():
-    messages_info = {'files': {}}
-    for i, msg_type in enumerate(request.form.getlist('message_type')):
-        if msg_type in ['image', 'imagemap']:
-            file_key = f'image_file_{i}'
-            if file_key in request.files:
-                file = request.files[file_key]
-                if file and allowed_file(file.filename):
-                    filename = secure_filename(f"{uuid4().hex}.png")
-                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    file.save(filepath)
-                    messages_info['files'][file_key] = filename
-
-    targeting_info = {
-        'targeting_type': request.form.get('targeting_type'),
-        'include_tags': request.form.getlist('include_tags'),
-        'exclude_tags': request.form.getlist('exclude_tags'),
-    }
-    messages_info.update({key: request.form.getlist(key) for key in request.form if key != 'send_at'})
-    
     send_at_str = request.form.get('send_at')
     name = request.form.get('broadcast_name', '無題の配信')
     if not send_at_str: return "予約日時が指定されていません。", 400
+    tz_name = request.form.get('timezone') or recurrence.DEFAULT_TIMEZONE
     try:
-        naive_dt = datetime.strptime(send_at_str, '%Y-%m-%d %H:%M')
-    except ValueError:
-        return "日時の形式が正しくありません。", 400
-    jst = timezone(timedelta(hours=9))
-    jst_dt = naive_dt.replace(tzinfo=jst)
-    utc_dt = jst_dt.astimezone(timezone.utc)
+        send_at = recurrence.parse_local(send_at_str, tz_name)
+        recurrence_rule = recurrence.normalize(request.form.get('recurrence'))
+    except recurrence.RecurrenceError as e:
+        return str(e), 400
+
     session = Session()
+    try:
+        template_id, payload = resolve_message_payload(session)
+        spread_minutes, max_per_minute = broadcasts.parse_spread(request.form)
+    except (message_templates.TemplateError, broadcasts.SpreadError) as e:
+        session.close()
+        return str(e), 400
+    targeting_info = targeting_info_from_form(request.form)
+    # テンプレートはIDで参照し、その場で作った内容は変換済みのJSONを保存する（送信時にフォームを解析し直さない）
+    messages_info = {'template_id': template_id} if template_id else {'payload': payload}
     new_broadcast = ScheduledBroadcast(
         name=name,
         targeting_info=json.dumps(targeting_info),
-        messages_info=json.dumps(messages_info),
-        send_at=utc_dt,
-        status='pending'
+        messages_info=json.dumps(messages_info, ensure_ascii=False),
+        send_at=send_at,
+        status='pending',
+        recurrence=recurrence_rule,
+        timezone=tz_name,
+        spread_minutes=spread_minutes,
+        max_per_minute=max_per_minute
     )
     session.add(new_broadcast)
     session.commit()
     session.close()
+    cache.invalidate(cache.PENDING_BROADCASTS_KEY)
     return redirect(url_for('admin_messaging_page'))
 
+# --- メッセージテンプレート ---
+@app.route("/admin/templates", methods=['GET', 'POST'])
+@auth_required
+def admin_templates_page():
+    session = Session()
+    if request.method == 'POST':
+        # メッセージ配信画面の作成フォームから、内容をテンプレートとして保存する
+        name = request.form.get('template_name', '').strip()
+        if not name:
+            session.close()
+            return "テンプレート名を入力してください。", 400
+        try:
+            image_files = save_uploaded_images(request.form, request.files)
+            payload = message_templates.compile_form(request.form, image_files, request_base_url())
+            message_templates.save_template(session, name, payload)
+        except message_templates.TemplateError as e:
+            session.close()
+            return str(e), 400
+        session.close()
+        return redirect(url_for('admin_templates_page'))
+
+    templates = session.query(MessageTemplate).order_by(MessageTemplate.name).all()
+    for template in templates:
+        template.payload_preview = json.dumps(json.loads(template.payload), ensure_ascii=False, indent=2)
+    session.close()
+    return render_template('templates.html', templates=templates)
+
+@app.route("/delete-template/<int:template_id>", methods=['POST'])
+@auth_required
+def delete_template(template_id):
+    session = Session()
+    try:
+        message_templates.delete_template(session, template_id)
+    except message_templates.TemplateError as e:
+        session.close()
+        return str(e), 400
+    session.close()
+    return redirect(url_for('admin_templates_page'))
+
 # --- LINE Bot本体の機能 ---
 @app.route("/callback", methods=['POST'])
 def callback():
-    session = Session()
-    channel_secret_setting = session.query(Setting).filter_by(key='line_channel_secret').first()
-    session.close()
-    if not channel_secret_setting or not channel_secret_setting.value:
+    channel_secret = get_credential('line_channel_secret')
+    if not channel_secret:
         return "OK"
-    handler = WebhookHandler(channel_secret_setting.value)
+    from linebot import WebhookHandler
+    from linebot.exceptions import InvalidSignatureError, LineBotApiError
+    from linebot.models import MessageEvent, TextMessage, TextSendMessage, FollowEvent
+    handler = WebhookHandler(channel_secret)
 
     @handler.add(FollowEvent)
     def handle_follow(event):
@@ -733,26 +1033,11 @@ def callback():
         session.add(new_message)
         session.commit()
         user = session.query(User).filter_by(id=user_id).first()
-        if user_message == "アンケート":
-            quick_reply_buttons = QuickReply(items=[QuickReplyButton(action=MessageAction(label="はい", text="はい")), QuickReplyButton(action=MessageAction(label="いいえ", text="いいえ"))])
-            reply_message = TextSendMessage(text="サービスに満足していますか？", quick_reply=quick_reply_buttons)
-            line_bot_api.reply_message(event.reply_token, reply_message)
-        elif user_message == "はい":
-            if user and "satisfied" not in user.tags:
-                user.tags += "satisfied,"
-                session.commit()
-                reply_text = "ありがとうございます！ご回答を記録しました。"
-            else:
-                reply_text = "ご回答ありがとうございます！"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
-        elif user_message == "いいえ":
-            if user and "unsatisfied" not in user.tags:
-                user.tags += "unsatisfied,"
-                session.commit()
-                reply_text = "ご意見ありがとうございます。今後の参考にさせていただきます。"
-            else:
-                reply_text = "ご意見ありがとうございます。"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
+        publish_message_event(user_id, user, new_message.id, user_message, 'user')
+        # 「はい」「いいえ」などはアンケートの回答待ちの間だけ回答として扱う
+        survey_reply = surveys.handle_text(session, user_id, user_message)
+        if survey_reply:
+            line_bot_api.reply_message(event.reply_token, survey_reply)
         elif user_message == "クーポン":
             if user and "coupon" not in user.tags:
                 user.tags += "coupon,"
@@ -771,6 +1056,11 @@ def callback():
         abort(400)
     return 'OK'
 
+@app.route("/metrics")
+@auth_required
+def metrics_endpoint():
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
 @app.route("/", methods=['GET'])
 def health_check():
     return 'OK'
@@ -0,0 +1,172 @@
+import hashlib
+import json
+
+from core import MessageTemplate, StepMessage, ScheduledBroadcast
+from broadcasts import build_messages
+import cache
+
+# --- メッセージテンプレート（保存済みの配信内容）---
+# 管理画面のフォームから組み立てたメッセージを LINE の上限で検証し、送信用のJSON（messages配列）へ
+# 一度だけ変換して保存する。送信時はフォームを解析し直さず、保存したJSONを RawMessage で包んで送る。
+# 保存後は内容を変更しない（作り直す場合は新しいテンプレートとして保存する）ため、長めにキャッシュできる。
+MAX_MESSAGES = 5
+MAX_TEXT_LENGTH = 5000
+MAX_ALT_TEXT_LENGTH = 400
+MAX_BUTTON_ACTIONS = 4
+MAX_CAROUSEL_COLUMNS = 10
+MAX_COLUMN_ACTIONS = 3
+MAX_TITLE_LENGTH = 40
+MAX_ACTION_LABEL_LENGTH = 20
+# ボタン・カラムの本文は、タイトルか画像がある場合に上限が短くなる
+MAX_BUTTON_TEXT_LENGTH = (160, 60)
+MAX_COLUMN_TEXT_LENGTH = (120, 60)
+TEMPLATE_CACHE_TTL = 3600
+
+
+class TemplateError(ValueError):
+    pass
+
+
+# --- 検証 ---
+def validate_form(request_form):
+    # build_messages は上限を超えた分を黙って切り捨てるため、組み立てる前に件数を確かめる
+    message_types = request_form.getlist('message_type')
+    if len(message_types) > MAX_MESSAGES:
+        raise TemplateError(f"一度に送れるメッセージは{MAX_MESSAGES}通までです（{len(message_types)}通あります）。")
+    action_message_indices = request_form.getlist('action_message_index', type=int)
+    column_message_indices = request_form.getlist('column_message_index', type=int)
+    action_column_indices = request_form.getlist('action_column_index', type=int)
+    for i, msg_type in enumerate(message_types):
+        if msg_type == 'button' and action_message_indices.count(i) > MAX_BUTTON_ACTIONS:
+            raise TemplateError(f"{i + 1}通目: ボタンのアクションは{MAX_BUTTON_ACTIONS}個までです。")
+        if msg_type == 'carousel' and column_message_indices.count(i) > MAX_CAROUSEL_COLUMNS:
+            raise TemplateError(f"{i + 1}通目: カルーセルのカラムは{MAX_CAROUSEL_COLUMNS}個までです。")
+    for column_index in set(action_column_indices):
+        if action_column_indices.count(column_index) > MAX_COLUMN_ACTIONS:
+            raise TemplateError(f"カルーセルの{column_index + 1}番目のカラム: アクションは{MAX_COLUMN_ACTIONS}個までです。")
+
+
+def _check_length(value, limit, label):
+    if value and len(value) > limit:
+        raise TemplateError(f"{label}は{limit}文字までです（{len(value)}文字あります）。")
+
+
+def _validate_actions(actions, limit, label):
+    if not actions:
+        raise TemplateError(f"{label}: アクションを1つ以上設定してください。")
+    if len(actions) > limit:
+        raise TemplateError(f"{label}: アクションは{limit}個までです。")
+    for action in actions:
+        _check_length(action.get('label'), MAX_ACTION_LABEL_LENGTH, f"{label}のアクションのラベル")
+
+
+def validate_payload(payload):
+    if not payload:
+        raise TemplateError("送信できるメッセージがありません。")
+    if len(payload) > MAX_MESSAGES:
+        raise TemplateError(f"一度に送れるメッセージは{MAX_MESSAGES}通までです。")
+    for n, message in enumerate(payload, 1):
+        label = f"{n}通目"
+        _check_length(message.get('text'), MAX_TEXT_LENGTH, f"{label}のテキスト")
+        _check_length(message.get('altText'), MAX_ALT_TEXT_LENGTH, f"{label}の説明文")
+        template = message.get('template') or {}
+        if template.get('type') == 'buttons':
+            _check_length(template.get('title'), MAX_TITLE_LENGTH, f"{label}のタイトル")
+            limit = MAX_BUTTON_TEXT_LENGTH[bool(template.get('title') or template.get('thumbnailImageUrl'))]
+            _check_length(template.get('text'), limit, f"{label}の本文")
+            _validate_actions(template.get('actions'), MAX_BUTTON_ACTIONS, label)
+        elif template.get('type') == 'carousel':
+            columns = template.get('columns') or []
+            if len(columns) > MAX_CAROUSEL_COLUMNS:
+                raise TemplateError(f"{label}: カルーセルのカラムは{MAX_CAROUSEL_COLUMNS}個までです。")
+            for c, column in enumerate(columns, 1):
+                column_label = f"{label}の{c}番目のカラム"
+                _check_length(column.get('title'), MAX_TITLE_LENGTH, f"{column_label}のタイトル")
+                limit = MAX_COLUMN_TEXT_LENGTH[bool(column.get('title') or column.get('thumbnailImageUrl'))]
+                _check_length(column.get('text'), limit, f"{column_label}の本文")
+                _validate_actions(column.get('actions'), MAX_COLUMN_ACTIONS, column_label)
+            # LINEの仕様で、カルーセルの全カラムはアクション数を揃える必要がある
+            if len({len(column.get('actions') or []) for column in columns}) > 1:
+                raise TemplateError(f"{label}: カルーセルの各カラムのアクション数を揃えてください。")
+
+
+# --- 変換 ---
+def compile_messages(messages):
+    payload = [message.as_json_dict() for message in messages]
+    validate_payload(payload)
+    return payload
+
+
+def compile_form(request_form, image_files, base_url):
+    validate_form(request_form)
+    return compile_messages(build_messages(request_form, image_files, base_url))
+
+
+def payload_hash(payload):
+    canonical = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+# --- 保存と読み込み ---
+def save_template(session, name, payload):
+    digest = payload_hash(payload)
+    existing = session.query(MessageTemplate).filter_by(payload_hash=digest).first()
+    if existing:
+        raise TemplateError(f"同じ内容のテンプレート「{existing.name}」が既にあります。")
+    template = MessageTemplate(
+        name=name,
+        payload=json.dumps(payload, ensure_ascii=False),
+        payload_hash=digest,
+        message_count=len(payload)
+    )
+    session.add(template)
+    session.commit()
+    cache.invalidate(cache.MESSAGE_TEMPLATES_KEY)
+    return template
+
+
+def _template_key(template_id):
+    return f'template:{template_id}'
+
+
+def get_template(session, template_id):
+    def load():
+        template = session.get(MessageTemplate, template_id)
+        if template is None:
+            return None
+        return {
+            'id': template.id,
+            'name': template.name,
+            'hash': template.payload_hash,
+            'payload': json.loads(template.payload),
+        }
+    template = cache.get_or_load(_template_key(template_id), load, ttl=TEMPLATE_CACHE_TTL)
+    if template is None:
+        # 存在しないIDを覚えておかない
+        cache.invalidate(_template_key(template_id))
+    return template
+
+
+def list_templates(session):
+    def load():
+        templates = session.query(MessageTemplate).order_by(MessageTemplate.name)
+        return [{'id': t.id, 'name': t.name, 'message_count': t.message_count} for t in templates]
+    return cache.get_or_load(cache.MESSAGE_TEMPLATES_KEY, load)
+
+
+def template_in_use(session, template_id):
+    if session.query(StepMessage.id).filter_by(template_id=template_id).first():
+        return True
+    pending = session.query(ScheduledBroadcast.messages_info).filter(ScheduledBroadcast.status == 'pending')
+    return any(json.loads(info).get('template_id') == template_id for (info,) in pending)
+
+
+def delete_template(session, template_id):
+    template = session.get(MessageTemplate, template_id)
+    if template is None:
+        return
+    if template_in_use(session, template_id):
+        raise TemplateError(f"テンプレート「{template.name}」はステップ配信か予約配信で使われているため削除できません。")
+    session.delete(template)
+    session.commit()
+    cache.invalidate(_template_key(template_id), cache.MESSAGE_TEMPLATES_KEY)
@@ -0,0 +1,328 @@
+import contextvars
+import os
+import re
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# --- Prometheus 形式のメトリクス ---
+# 外部ライブラリに頼らず、カウンタ / ゲージ / ヒストグラムと text format (0.0.4) の出力だけを実装する。
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_MS', 500)) / 1000
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra or [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted(self._values.items())
+        lines.extend(self._render_items(items))
+        return lines
+
+    def _render_items(self, items):
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}' for key, value in items]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['counts'][i] += 1
+            state['sum'] += value
+            state['count'] += 1
+
+    def _render_items(self, items):
+        lines = []
+        for key, state in items:
+            for bound, count in zip(self.buckets, state['counts']):
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                lines.append(f'{self.name}_bucket{labels} {count}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(state["sum"])}')
+            lines.append(f'{self.name}_count{labels} {state["count"]}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        # 出力の直前に呼ばれ、キャッシュ統計などの値をゲージへ反映する
+        self._collectors.append(collector)
+
+    def render(self):
+        for collector in self._collectors:
+            collector()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# --- Web（main.py）---
+http_request_seconds = registry.register(Histogram(
+    'linebot_http_request_duration_seconds', 'HTTPリクエストの処理時間', ('method', 'route', 'status')))
+http_request_queries = registry.register(Histogram(
+    'linebot_http_request_sql_queries', '1リクエストあたりのSQL実行回数', ('method', 'route'), QUERY_COUNT_BUCKETS))
+http_request_sql_seconds = registry.register(Histogram(
+    'linebot_http_request_sql_duration_seconds', '1リクエストあたりのSQL実行時間の合計', ('method', 'route')))
+http_slow_requests = registry.register(Counter(
+    'linebot_http_slow_requests_total', 'SLOW_REQUEST_MS を超えたリクエスト数', ('method', 'route')))
+
+sse_rejected = registry.register(Counter(
+    'linebot_sse_rejected_total', '同時接続数の上限で受け付けなかったSSE接続の数'))
+
+# --- LINE Messaging API ---
+line_api_seconds = registry.register(Histogram(
+    'linebot_line_api_request_duration_seconds', 'LINE APIの呼び出し時間', ('method', 'endpoint', 'status')))
+
+# --- バッチ（step_delivery.py）---
+batch_cycle_seconds = registry.register(Histogram(
+    'linebot_batch_cycle_duration_seconds', 'バッチ1サイクルの処理時間', ('result',)))
+batch_backlog = registry.register(Gauge(
+    'linebot_batch_backlog', 'サイクル開始時点で送信待ちの件数', ('kind',)))
+batch_last_cycle_timestamp = registry.register(Gauge(
+    'linebot_batch_last_cycle_timestamp_seconds', '最後にバッチが完了した時刻(UNIX秒)'))
+spread_inbound_per_minute = registry.register(Gauge(
+    'linebot_spread_inbound_messages_per_minute', '分散配信の速度調整に使った直近1分間の受信メッセージ数'))
+spread_pacing_factor = registry.register(Gauge(
+    'linebot_spread_pacing_factor', '分散配信の速度（1.0 で予定どおり）'))
+spread_lag_seconds = registry.register(Gauge(
+    'linebot_spread_lag_seconds', '受信の混雑で分散配信を遅らせている秒数'))
+spread_sent_recipients = registry.register(Counter(
+    'linebot_spread_sent_recipients_total', '分散配信で送信した宛先の数', ('source', 'result')))
+
+
+# --- SQLの計測（エンジンのイベントフック）---
+_request_stats = contextvars.ContextVar('linebot_request_stats', default=None)
+_hooks_installed = False
+_hooks_lock = threading.Lock()
+
+
+class RequestStats:
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.query_count = 0
+        self.sql_seconds = 0.0
+        self.statements = {}
+
+    def record_query(self, statement, elapsed):
+        self.query_count += 1
+        self.sql_seconds += elapsed
+        # 内訳はSQL文ごとに集計する（同じ文が大量に並ぶ = N+1 の兆候）
+        key = ' '.join(statement.split())[:160]
+        count, total = self.statements.get(key, (0, 0.0))
+        self.statements[key] = (count + 1, total + elapsed)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('linebot_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['linebot_query_start'].pop()
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.record_query(statement, time.perf_counter() - started)
+
+
+def _handle_error(exception_context):
+    # 失敗した文では after_cursor_execute が呼ばれないため、ここで開始時刻を取り除く
+    # （プールで使い回す接続の conn.info に溜まっていかないように）
+    conn = exception_context.connection
+    starts = conn.info.get('linebot_query_start') if conn is not None else None
+    if starts:
+        starts.pop()
+
+
+def install_sql_hooks():
+    global _hooks_installed
+    with _hooks_lock:
+        if _hooks_installed:
+            return
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+        _hooks_installed = True
+
+
+def start_request():
+    stats = RequestStats()
+    _request_stats.set(stats)
+    return stats
+
+
+def finish_request(method, route, status):
+    stats = _request_stats.get()
+    if stats is None:
+        return
+    _request_stats.set(None)
+    elapsed = time.perf_counter() - stats.started_at
+    http_request_seconds.observe(elapsed, method=method, route=route, status=status)
+    http_request_queries.observe(stats.query_count, method=method, route=route)
+    http_request_sql_seconds.observe(stats.sql_seconds, method=method, route=route)
+    if elapsed >= SLOW_REQUEST_SECONDS:
+        http_slow_requests.inc(method=method, route=route)
+        log_slow_request(method, route, status, elapsed, stats)
+
+
+def log_slow_request(method, route, status, elapsed, stats):
+    print(f"!!! 遅いリクエスト: {method} {route} -> {status} {elapsed * 1000:.1f}ms "
+          f"(SQL {stats.query_count}回 / {stats.sql_seconds * 1000:.1f}ms)")
+    breakdown = sorted(stats.statements.items(), key=lambda item: item[1][1], reverse=True)
+    for statement, (count, total) in breakdown[:10]:
+        print(f"    {count:>4}回 {total * 1000:>8.1f}ms  {statement}")
+
+
+# --- LINE APIの計測 ---
+# /v2/bot/profile/Uxxxx のようなIDを含むパスは、ラベルが増え続けないよう {id} に置き換える
+_ID_SEGMENT = re.compile(r'/[A-Za-z0-9_-]{20,}')
+_timed_http_client = None
+
+
+def normalize_line_path(url):
+    path = re.sub(r'^https?://[^/]+', '', url).split('?', 1)[0]
+    return _ID_SEGMENT.sub('/{id}', path)
+
+
+def get_timed_http_client():
+    # linebot は重いため、LINE APIを初めて使う時にクラスを組み立てる
+    global _timed_http_client
+    if _timed_http_client is not None:
+        return _timed_http_client
+    from linebot import RequestsHttpClient
+
+    class TimedHttpClient(RequestsHttpClient):
+        def _timed(self, method, call, url, *args, **kwargs):
+            started = time.perf_counter()
+            status = 'error'
+            try:
+                response = call(url, *args, **kwargs)
+                status = response.status_code
+                return response
+            finally:
+                line_api_seconds.observe(time.perf_counter() - started, method=method,
+                                         endpoint=normalize_line_path(url), status=status)
+
+        def get(self, url, *args, **kwargs):
+            return self._timed('GET', super().get, url, *args, **kwargs)
+
+        def post(self, url, *args, **kwargs):
+            return self._timed('POST', super().post, url, *args, **kwargs)
+
+        def put(self, url, *args, **kwargs):
+            return self._timed('PUT', super().put, url, *args, **kwargs)
+
+        def delete(self, url, *args, **kwargs):
+            return self._timed('DELETE', super().delete, url, *args, **kwargs)
+
+    _timed_http_client = TimedHttpClient
+    return _timed_http_client
+
+
+# --- バッチ用の /metrics サーバー ---
+def serve_metrics(port, username, password, host='0.0.0.0'):
+    import base64
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    # 認証なしでは公開しない
+    if not username or not password:
+        raise ValueError("メトリクスの公開には ADMIN_USERNAME と ADMIN_PASSWORD の設定が必要です。")
+    expected_auth = 'Basic ' + base64.b64encode(f'{username}:{password}'.encode()).decode()
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_response(404)
+                self.end_headers()
+                return
+            if self.headers.get('Authorization') != expected_auth:
+                self.send_response(401)
+                self.send_header('WWW-Authenticate', 'Basic realm="Login Required"')
+                self.end_headers()
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,67 @@
+import re
+
+# --- 配信メッセージの差し込み（{nickname} / {display_name}）---
+# テンプレートは一度だけ解析してパーツ列に変換し、ユーザーごとには連結のみを行う。
+PLACEHOLDER_PATTERN = re.compile(r'\{(nickname|display_name)\}')
+MULTICAST_CHUNK_SIZE = 150
+
+
+class CompiledTemplate:
+    def __init__(self, text):
+        self.text = text
+        # 偶数番目がリテラル、奇数番目がプレースホルダ名
+        self.parts = PLACEHOLDER_PATTERN.split(text)
+        self.is_static = len(self.parts) == 1
+
+    def render(self, user):
+        if self.is_static:
+            return self.text
+        values = user_placeholder_values(user)
+        rendered = []
+        for i, part in enumerate(self.parts):
+            rendered.append(values[part] if i % 2 else part)
+        return ''.join(rendered)
+
+
+def user_placeholder_values(user):
+    display_name = user.display_name or ''
+    return {
+        'display_name': display_name,
+        # ニックネーム未設定のユーザーにはLINE表示名を差し込む
+        'nickname': user.nickname or display_name,
+    }
+
+
+def compile_template(text):
+    return CompiledTemplate(text or '')
+
+
+def has_placeholders(text):
+    return bool(text) and PLACEHOLDER_PATTERN.search(text) is not None
+
+
+def group_recipients(users, templates):
+    # 差し込み後の内容が同一のユーザーをまとめる（キーは各テンプレートの描画結果のタプル）
+    groups = {}
+    for user in users:
+        key = tuple(template.render(user) for template in templates)
+        groups.setdefault(key, []).append(user.id)
+    return groups
+
+
+def deliver_grouped(line_bot_api, groups, build_messages, on_sent=None):
+    # 複数人が同じ内容になるグループは multicast、1人だけのグループは push で送る
+    for rendered, user_ids in groups.items():
+        messages = build_messages(rendered)
+        if not messages:
+            continue
+        if len(user_ids) == 1:
+            line_bot_api.push_message(user_ids[0], messages)
+            if on_sent:
+                on_sent(user_ids)
+            continue
+        for i in range(0, len(user_ids), MULTICAST_CHUNK_SIZE):
+            chunk = user_ids[i:i + MULTICAST_CHUNK_SIZE]
+            line_bot_api.multicast(chunk, messages)
+            if on_sent:
+                on_sent(chunk)
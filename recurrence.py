@@ -0,0 +1,172 @@
+import os
+from datetime import datetime, timezone, timedelta
+from functools import lru_cache
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+# --- 予約のタイムゾーンと繰り返し（cron形式）---
+# 予約日時は指定したタイムゾーンの壁時計の時刻として入力し、DBにはUTCで保存する。
+# 繰り返しは「分 時 日 月 曜日」の5項目（例: 毎週月曜9時 = "0 9 * * 1"）。
+# send_at には常に「次の1回分」だけを持たせ、送信後に次回の時刻を計算して上書きする。
+DEFAULT_TIMEZONE = os.environ.get('DEFAULT_TIMEZONE', 'Asia/Tokyo')
+DATETIME_FORMAT = '%Y-%m-%d %H:%M'
+TIMEZONE_CHOICES = [
+    'Asia/Tokyo', 'UTC', 'Asia/Seoul', 'Asia/Shanghai', 'Asia/Taipei', 'Asia/Bangkok',
+    'Asia/Singapore', 'Europe/London', 'Europe/Paris', 'America/New_York', 'America/Los_Angeles',
+]
+ALIASES = {
+    '@hourly': '0 * * * *',
+    '@daily': '0 0 * * *',
+    '@weekly': '0 0 * * 0',
+    '@monthly': '0 0 1 * *',
+}
+# 2月30日のように一致する日が来ない指定は、この年数だけ探して諦める
+MAX_SEARCH_YEARS = 5
+CRON_FIELDS = (('分', 0, 59), ('時', 0, 23), ('日', 1, 31), ('月', 1, 12), ('曜日', 0, 7))
+
+
+class RecurrenceError(ValueError):
+    pass
+
+
+# --- タイムゾーン ---
+def get_zone(name=None):
+    try:
+        return ZoneInfo(name or DEFAULT_TIMEZONE)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise RecurrenceError(f"タイムゾーン「{name}」が見つかりません。")
+
+
+def as_utc(dt):
+    # SQLiteではタイムゾーンなしで返るため、UTCとして扱う
+    return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt.astimezone(timezone.utc)
+
+
+def parse_local(text, tz_name=None):
+    try:
+        naive_dt = datetime.strptime(text.strip(), DATETIME_FORMAT)
+    except ValueError:
+        raise RecurrenceError("日時の形式が正しくありません。")
+    return naive_dt.replace(tzinfo=get_zone(tz_name)).astimezone(timezone.utc)
+
+
+def format_local(dt, tz_name=None):
+    return as_utc(dt).astimezone(get_zone(tz_name)).strftime(DATETIME_FORMAT)
+
+
+# --- cron形式の繰り返し ---
+def _parse_field(text, name, low, high):
+    values = set()
+    for part in text.split(','):
+        step = 1
+        if '/' in part:
+            part, step_text = part.split('/', 1)
+            if not step_text.isdigit() or int(step_text) == 0:
+                raise RecurrenceError(f"{name}の間隔「{step_text}」が正しくありません。")
+            step = int(step_text)
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start_text, end_text = part.split('-', 1)
+            if not start_text.isdigit() or not end_text.isdigit():
+                raise RecurrenceError(f"{name}の範囲「{part}」が正しくありません。")
+            start, end = int(start_text), int(end_text)
+        elif part.isdigit():
+            start = int(part)
+            end = high if step > 1 else start
+        else:
+            raise RecurrenceError(f"{name}の指定「{part}」が正しくありません。")
+        if start < low or end > high or start > end:
+            raise RecurrenceError(f"{name}は{low}〜{high}の範囲で指定してください。")
+        values.update(range(start, end + 1, step))
+    return sorted(values)
+
+
+class CronSchedule:
+    def __init__(self, expression):
+        fields = ALIASES.get(expression, expression).split()
+        if len(fields) != 5:
+            raise RecurrenceError("繰り返しは「分 時 日 月 曜日」の5項目で指定してください（例: 0 9 * * 1）。")
+        parsed = [_parse_field(text, *spec) for text, spec in zip(fields, CRON_FIELDS)]
+        self.minutes, self.hours, self.days, self.months, weekdays = parsed
+        # 0 と 7 はどちらも日曜日
+        self.weekdays = {day % 7 for day in weekdays}
+        # cron と同じく、日と曜日の両方を指定した場合はどちらかに一致すればよい
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    def _day_matches(self, dt):
+        day_ok = dt.day in self.days
+        # datetime.weekday() は月曜 = 0、cron は日曜 = 0
+        weekday_ok = (dt.weekday() + 1) % 7 in self.weekdays
+        if self.any_day and self.any_weekday:
+            return True
+        if self.any_day:
+            return weekday_ok
+        if self.any_weekday:
+            return day_ok
+        return day_ok or weekday_ok
+
+    def next_local(self, after):
+        # after（タイムゾーンなしの壁時計の時刻）より後で条件に合う最初の時刻。
+        # 月 → 日 → 時 → 分の順に、合わない単位ごとまとめて読み飛ばす。
+        candidate = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit_year = candidate.year + MAX_SEARCH_YEARS
+        while candidate.year <= limit_year:
+            if candidate.month not in self.months:
+                later = [m for m in self.months if m > candidate.month]
+                if later:
+                    candidate = datetime(candidate.year, later[0], 1)
+                else:
+                    candidate = datetime(candidate.year + 1, self.months[0], 1)
+                continue
+            if not self._day_matches(candidate):
+                candidate = datetime(candidate.year, candidate.month, candidate.day) + timedelta(days=1)
+                continue
+            if candidate.hour not in self.hours:
+                later = [h for h in self.hours if h > candidate.hour]
+                if later:
+                    candidate = candidate.replace(hour=later[0], minute=0)
+                else:
+                    candidate = datetime(candidate.year, candidate.month, candidate.day) + timedelta(days=1)
+                continue
+            if candidate.minute not in self.minutes:
+                later = [m for m in self.minutes if m > candidate.minute]
+                if later:
+                    candidate = candidate.replace(minute=later[0])
+                else:
+                    candidate = candidate.replace(minute=0) + timedelta(hours=1)
+                continue
+            return candidate
+        raise RecurrenceError("繰り返しの条件に一致する日時がありません。")
+
+
+@lru_cache(maxsize=256)
+def compile_schedule(expression):
+    return CronSchedule(expression)
+
+
+def normalize(expression):
+    # 空欄は「繰り返しなし」。保存前に検証し、空白を揃えた形にする
+    expression = ' '.join((expression or '').split())
+    if not expression:
+        return None
+    # 2月30日のように実行日が来ない指定もここで弾く
+    compile_schedule(expression).next_local(datetime.now())
+    return expression
+
+
+def next_run(expression, tz_name, after):
+    zone = get_zone(tz_name)
+    schedule = compile_schedule(expression)
+    local = as_utc(after).astimezone(zone).replace(tzinfo=None)
+    while True:
+        local = schedule.next_local(local)
+        aware = local.replace(tzinfo=zone)
+        # 夏時間の切り替えで存在しない時刻は飛ばす
+        if aware.astimezone(timezone.utc).astimezone(zone).replace(tzinfo=None) == local:
+            return aware.astimezone(timezone.utc)
+
+
+def advance(expression, tz_name, scheduled_at, now):
+    # 止まっていた間の回はまとめて送らず、現在時刻より後の最初の回へ進める
+    return next_run(expression, tz_name, max(as_utc(scheduled_at), now))
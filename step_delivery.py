@@ -1,91 +1,52 @@
+import json
 import os
 import sys
 import time
 from datetime import datetime, timezone, timedelta
 from dotenv import load_dotenv
 
-from linebot import (
-    LineBotApi
-)
-from linebot.exceptions import (
-    LineBotApiError
-)
-from linebot.models import (
-    TextSendMessage
-)
+from sqlalchemy import func
 
-from sqlalchemy import create_engine, Column, String, DateTime, func, Integer, Text
-from sqlalchemy.orm import sessionmaker, declarative_base
+from core import (
+    get_database_url, get_engine, migrate_schema, Session, get_line_bot_api,
+    User, StepMessage, Message, ScheduledMessage, ScheduledBroadcast, BatchRunLog, DeliveryChunk
+)
+from werkzeug.datastructures import MultiDict
+import broadcasts
+import bulk_tags
+import cache
+import events
+import message_templates
+import metrics
+import recurrence
+import surveys
 
 # .envファイルをロード
 load_dotenv()
 
-print("--- ステップ配信・予約投稿バッチ開始 ---")
-
-# --- 環境変数から設定を取得 ---
-channel_access_token = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN')
-db_url_from_env = os.environ.get('DATABASE_URL')
-
-if db_url_from_env and db_url_from_env.startswith("postgres://"):
-    database_url = db_url_from_env.replace("postgres://", "postgresql+psycopg://", 1)
-else:
-    database_url = db_url_from_env
-
-if not all([channel_access_token, database_url]):
-    print("!!! エラー: 必要な環境変数が設定されていません。")
-    sys.exit(1)
-
-line_bot_api = LineBotApi(channel_access_token)
-
-# --- データベースのモデル定義 (main.pyと完全に合わせる) ---
-Base = declarative_base()
-class User(Base):
-    __tablename__ = 'users'
-    id = Column(String, primary_key=True)
-    display_name = Column(String)
-    nickname = Column(String)
-    tags = Column(String, default="")
-    status = Column(String, default="未対応")
-    sent_steps = Column(String, default="")
-    created_at = Column(DateTime, server_default=func.now())
-
-class StepMessage(Base):
-    __tablename__ = 'step_messages'
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    days_after = Column(Integer, nullable=False)
-    message_text = Column(Text, nullable=False)
-    
-class Message(Base):
-    __tablename__ = 'messages'
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(String, nullable=False)
-    sender_type = Column(String, nullable=False)
-    content = Column(Text, nullable=False)
-    created_at = Column(DateTime, server_default=func.now())
-
-class ScheduledMessage(Base):
-    __tablename__ = 'scheduled_messages'
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(String, nullable=False)
-    message_text = Column(Text, nullable=False)
-    send_at = Column(DateTime(timezone=True), nullable=False)
-    status = Column(String, default='pending')
-
-class BatchRunLog(Base):
-    __tablename__ = 'batch_run_log'
-    id = Column(Integer, primary_key=True)
-    last_step_check_date = Column(DateTime, nullable=False)
-
-try:
-    engine = create_engine(database_url, pool_pre_ping=True)
-    Base.metadata.create_all(engine)
-    Session = sessionmaker(bind=engine)
-except Exception as e:
-    print(f"!!! データベース接続でエラー: {e}")
-    sys.exit(1)
+BATCH_INTERVAL_SECONDS = 60
+# 分散配信の速度調整: 直近1分間の受信がこの件数を超えたら、超えた割合に応じて送信を遅らせる
+INBOUND_TARGET_PER_MINUTE = int(os.environ.get('INBOUND_TARGET_PER_MINUTE', 120))
+MIN_PACING_FACTOR = 0.1
+# 遅れを取り戻す時も、1回の確認で送るまとまりはこの数まで
+MAX_CHUNKS_PER_TICK = 20
+# 送信に失敗したまとまりは、未送信の宛先だけを CHUNK_RETRY_SECONDS × 回数 後に送り直す。
+# MAX_CHUNK_ATTEMPTS 回失敗したら error にして、管理画面から再送・破棄できるようにする
+MAX_CHUNK_ATTEMPTS = 3
+CHUNK_RETRY_SECONDS = 60
 
 # --- 配信ロジック ---
+def step_payload(session, scenario):
+    # テンプレートが選ばれていればその内容を、なければ本文のテキスト1通を送る
+    if scenario.template_id:
+        template = message_templates.get_template(session, scenario.template_id)
+        if template is None:
+            raise message_templates.TemplateError(f"テンプレート(ID: {scenario.template_id})が見つかりません。")
+        return template['payload']
+    return [{'type': 'text', 'text': scenario.message_text}]
+
 def process_step_messages(session, line_bot_api):
+    from linebot.exceptions import LineBotApiError
     print("--- ステップ配信のチェック開始 ---")
     today = datetime.now(timezone.utc).date()
     
@@ -113,16 +74,30 @@ def process_step_messages(session, line_bot_api):
                 users_to_send.append(user)
         
         if users_to_send:
-            user_ids_to_send = [user.id for user in users_to_send]
-            try:
-                print(f"登録{scenario.days_after}日後の{len(user_ids_to_send)}人にメッセージを送信します...")
-                line_bot_api.multicast(user_ids_to_send, TextSendMessage(text=scenario.message_text))
-                
-                for user in users_to_send:
-                    user.sent_steps += f"{scenario.days_after},"
+            users_by_id = {user.id: user for user in users_to_send}
+
+            def mark_sent(user_ids):
+                for user_id in user_ids:
+                    users_by_id[user_id].sent_steps += f"{scenario.days_after},"
                 session.commit()
+
+            try:
+                payload = step_payload(session, scenario)
+                if scenario.spread_minutes or scenario.max_per_minute:
+                    # 送信記録はまとまりと同じコミットで付ける（後のシナリオでバッチが中断しても、次の回に二重に予約しない）
+                    chunks = broadcasts.enqueue_spread(
+                        session, 'step', scenario.id, users_to_send, payload, datetime.now(timezone.utc),
+                        scenario.spread_minutes, scenario.max_per_minute
+                    )
+                    for user in users_to_send:
+                        user.sent_steps += f"{scenario.days_after},"
+                    session.commit()
+                    print(f"登録{scenario.days_after}日後の{len(users_to_send)}人への送信を{len(chunks)}回に分けて予約しました。")
+                    continue
+                print(f"登録{scenario.days_after}日後の{len(users_to_send)}人にメッセージを送信します...")
+                broadcasts.deliver(line_bot_api, users_to_send, payload, on_sent=mark_sent)
                 print("送信記録をデータベースに保存しました。")
-            except LineBotApiError as e:
+            except (LineBotApiError, message_templates.TemplateError) as e:
                 print(f"!!! ステップ配信(ID: {scenario.id})の送信でエラー: {e}")
                 session.rollback()
 
@@ -133,19 +108,39 @@ def process_step_messages(session, line_bot_api):
         session.add(new_log)
     session.commit()
 
+def schedule_next_run(row, now, sent_status):
+    # 繰り返しの予約は次回の時刻へ進めて pending のまま残し、1回だけの予約は結果のステータスにする
+    if not row.recurrence:
+        row.status = sent_status
+        return
+    try:
+        row.send_at = recurrence.advance(row.recurrence, row.timezone, row.send_at, now)
+        row.status = 'pending'
+    except recurrence.RecurrenceError as e:
+        print(f"!!! 繰り返しの次回日時を計算できません ({row.recurrence}): {e}")
+        row.status = 'error'
+
+def due_query(session, model, now):
+    # (status, send_at) のインデックスで送信時刻を過ぎたものだけを取り出す。
+    # PostgreSQL では他のバッチが処理中の行を飛ばす（SQLite では FOR UPDATE は無視される）
+    return session.query(model).filter(
+        model.status == 'pending',
+        model.send_at <= now
+    ).order_by(model.send_at).with_for_update(skip_locked=True)
+
 def process_scheduled_messages(session, line_bot_api):
+    from linebot.exceptions import LineBotApiError
+    from linebot.models import TextSendMessage
     print("--- 予約投稿のチェック開始 ---")
     now = datetime.now(timezone.utc)
     
-    messages_to_send = session.query(ScheduledMessage).filter(
-        ScheduledMessage.status == 'pending',
-        ScheduledMessage.send_at <= now
-    ).all()
+    messages_to_send = due_query(session, ScheduledMessage, now).all()
 
     if not messages_to_send:
         print("送信すべき予約投稿はありません。")
         return
 
+    results = []
     for msg in messages_to_send:
         try:
             print(f"予約投稿を送信します (To: {msg.user_id})")
@@ -158,31 +153,284 @@ def process_scheduled_messages(session, line_bot_api):
                 created_at=now
             )
             session.add(history_message)
-            
-            msg.status = 'sent'
+            session.flush()
+            sent_status = 'sent'
         except LineBotApiError as e:
             print(f"!!! 予約投稿(ID: {msg.id})の送信でエラー: {e}")
-            msg.status = 'error'
-    
+            sent_status = 'error'
+        schedule_next_run(msg, now, sent_status)
+        # コミットで属性が失効する前に、管理画面へ通知する内容を控えておく
+        next_send_at = recurrence.format_local(msg.send_at, msg.timezone) if msg.status == 'pending' else None
+        message_id = history_message.id if sent_status == 'sent' else None
+        results.append((msg.id, msg.user_id, sent_status, next_send_at, message_id, msg.message_text))
     session.commit()
+
+    for msg_id, user_id, status, next_send_at, message_id, message_text in results:
+        events.publish(get_engine(), 'scheduled', {
+            'id': msg_id, 'user_id': user_id, 'status': status, 'next_send_at': next_send_at
+        })
+        if status == 'sent':
+            events.publish(get_engine(), 'message', {
+                'user_id': user_id,
+                'message_id': message_id,
+                'sender_type': 'admin',
+                **events.preview(message_text),
+                'created_at': now.strftime('%m-%d %H:%M'),
+            })
     print(f"{len(messages_to_send)}件の予約投稿を処理しました。")
 
+def build_broadcast_payload(session, broadcast):
+    # 予約時に保存したテンプレートID か変換済みのJSONを使う
+    messages_info = json.loads(broadcast.messages_info)
+    if messages_info.get('template_id'):
+        template = message_templates.get_template(session, messages_info['template_id'])
+        if template is None:
+            raise message_templates.TemplateError(f"テンプレート(ID: {messages_info['template_id']})が見つかりません。")
+        return template['payload']
+    if 'payload' in messages_info:
+        return messages_info['payload']
+    # 以前の形式（フォームの入力をそのまま保存したもの）は、即時送信と同じ方法で組み立て直す
+    form = MultiDict([
+        (key, value) for key, values in messages_info.items()
+        if key not in ('files', 'base_url') for value in values
+    ])
+    base_url = broadcasts.public_base_url() or messages_info.get('base_url')
+    return message_templates.compile_messages(
+        broadcasts.build_messages(form, messages_info.get('files', {}), base_url)
+    )
+
+def process_scheduled_broadcasts(session, line_bot_api):
+    from linebot.exceptions import LineBotApiError
+    print("--- 予約配信のチェック開始 ---")
+    processed = 0
+    while True:
+        # 1件ずつ取り出して送信し、コミットしてから次へ進む
+        now = datetime.now(timezone.utc)
+        broadcast = due_query(session, ScheduledBroadcast, now).first()
+        if broadcast is None:
+            break
+        processed += 1
+        try:
+            targeting_info = json.loads(broadcast.targeting_info)
+            users = broadcasts.select_recipients(
+                session,
+                targeting_info.get('targeting_type'),
+                targeting_info.get('include_tags', []),
+                targeting_info.get('exclude_tags', [])
+            )
+            payload = build_broadcast_payload(session, broadcast)
+            if users and (broadcast.spread_minutes or broadcast.max_per_minute):
+                chunks = broadcasts.enqueue_spread(
+                    session, 'broadcast', broadcast.id, users, payload, now,
+                    broadcast.spread_minutes, broadcast.max_per_minute
+                )
+                print(f"予約配信「{broadcast.name}」の{len(users)}人への送信を{len(chunks)}回に分けて予約しました。")
+                # 1回だけの配信は、全て送り終わるまで「送信中」として一覧に残す（停止もできる）
+                sent_status = 'sending'
+            elif users:
+                print(f"予約配信「{broadcast.name}」を{len(users)}人に送信します...")
+                broadcasts.deliver(line_bot_api, users, payload)
+                sent_status = 'sent'
+            else:
+                sent_status = 'sent'
+        except (LineBotApiError, ValueError) as e:
+            print(f"!!! 予約配信(ID: {broadcast.id})の送信でエラー: {e}")
+            sent_status = 'error'
+        schedule_next_run(broadcast, now, sent_status)
+        session.commit()
+
+    if processed:
+        cache.invalidate(cache.PENDING_BROADCASTS_KEY)
+        print(f"{processed}件の予約配信を処理しました。")
+    else:
+        print("送信すべき予約配信はありません。")
+
+# --- 分散配信のまとまりを送る（BATCH_INTERVAL_SECONDS より短い間隔で呼ぶ）---
+def inbound_per_minute(session, now):
+    # 直近1分間にユーザーから届いたメッセージ数を /callback の混み具合の目安にする
+    # （Message.created_at はタイムゾーンなしのUTCで保存されている）
+    since = (now - timedelta(minutes=1)).replace(tzinfo=None)
+    return session.query(func.count(Message.id)).filter(
+        Message.sender_type == 'user',
+        Message.created_at >= since
+    ).scalar()
+
+def pacing_factor(inbound):
+    if inbound <= INBOUND_TARGET_PER_MINUTE:
+        return 1.0
+    return max(MIN_PACING_FACTOR, INBOUND_TARGET_PER_MINUTE / inbound)
+
+class SpreadPacer:
+    # 分散配信の時計。受信が多い間は時計の進みを遅くして、未送信のまとまり全体の予定を同じだけ後ろへずらす。
+    # 行の send_after は書き換えないので、混雑が収まっても遅れた分を一度に送ることはない
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lag = timedelta(0)
+        self.last_tick = None
+        metrics.spread_lag_seconds.set(0)
+
+    def clock(self, session, now):
+        inbound = inbound_per_minute(session, now)
+        factor = pacing_factor(inbound)
+        if self.last_tick is not None:
+            self.lag += (now - self.last_tick) * (1 - factor)
+        self.last_tick = now
+        metrics.spread_inbound_per_minute.set(inbound)
+        metrics.spread_pacing_factor.set(factor)
+        metrics.spread_lag_seconds.set(self.lag.total_seconds())
+        if factor < 1:
+            print(f"受信が多いため分散配信を減速しています（直近1分 {inbound}件, 速度 {factor:.2f}, 遅れ {self.lag.total_seconds():.0f}秒）")
+        return now - self.lag
+
+def has_pending_chunks(session):
+    return session.query(DeliveryChunk.id).filter(DeliveryChunk.status == 'pending').first() is not None
+
+def send_chunk(session, line_bot_api, chunk):
+    # 送信できたまとまりは削除するため、コミット後に使う値を先に取り出しておく
+    source, source_id = chunk.source, chunk.source_id
+    user_ids = json.loads(chunk.user_ids)
+    users = session.query(User).filter(User.id.in_(user_ids)).all()
+    sent_ids = set()
+
+    def on_sent(sent_user_ids):
+        # 途中で失敗しても、送れた宛先には2回送らない
+        sent_ids.update(sent_user_ids)
+
+    try:
+        broadcasts.deliver(line_bot_api, users, broadcasts.load_payload(session, chunk), on_sent)
+        session.delete(chunk)
+        result = 'sent'
+    except Exception as e:
+        remaining = [user.id for user in users if user.id not in sent_ids]
+        chunk.user_ids = json.dumps(remaining)
+        chunk.recipient_count = len(remaining)
+        chunk.attempts = (chunk.attempts or 0) + 1
+        chunk.last_error = str(e)[:500]
+        if chunk.attempts < MAX_CHUNK_ATTEMPTS:
+            chunk.send_after = datetime.now(timezone.utc) + timedelta(seconds=CHUNK_RETRY_SECONDS * chunk.attempts)
+            print(f"!!! 分散配信(ID: {chunk.id})の送信でエラー。{len(remaining)}人分を後で送り直します: {e}")
+        else:
+            chunk.status = 'error'
+            print(f"!!! 分散配信(ID: {chunk.id})の送信を{chunk.attempts}回失敗したため中止しました: {e}")
+        result = 'error'
+    if source == 'broadcast' and source_id:
+        session.flush()
+        broadcasts.finish_queued_broadcast(session, source_id)
+    session.commit()
+    if source == 'broadcast':
+        # 一覧の進捗（残りの人数）を更新する
+        cache.invalidate(cache.PENDING_BROADCASTS_KEY)
+    sent_count = len(users) if result == 'sent' else len(sent_ids)
+    metrics.spread_sent_recipients.inc(sent_count, source=source, result='sent')
+    if result == 'error':
+        metrics.spread_sent_recipients.inc(len(users) - sent_count, source=source, result='error')
+
+def process_delivery_chunks(session, line_bot_api, pacer):
+    clock = pacer.clock(session, datetime.now(timezone.utc))
+    sent = 0
+    while sent < MAX_CHUNKS_PER_TICK:
+        # 予約配信と同じく1件ずつ取り出し、送信ごとにコミットする
+        chunk = session.query(DeliveryChunk).filter(
+            DeliveryChunk.status == 'pending',
+            DeliveryChunk.send_after <= clock
+        ).order_by(DeliveryChunk.send_after).with_for_update(skip_locked=True).first()
+        if chunk is None:
+            break
+        send_chunk(session, line_bot_api, chunk)
+        sent += 1
+    return sent
+
+def run_spread_tick(pacer):
+    session = Session()
+    try:
+        if not has_pending_chunks(session):
+            pacer.reset()
+            return
+        line_bot_api = get_line_bot_api(session)
+        if line_bot_api:
+            sent = process_delivery_chunks(session, line_bot_api, pacer)
+            if sent:
+                print(f"分散配信のまとまりを{sent}件処理しました。")
+            # 送り切ったら遅れをなくし、次の配信は予定どおりの時刻から始める
+            if not has_pending_chunks(session):
+                pacer.reset()
+    except Exception as e:
+        print(f"!!! 分散配信中に予期せぬエラーが発生: {e}")
+        session.rollback()
+    finally:
+        Session.remove()
+
+def record_backlog(session):
+    now = datetime.now(timezone.utc)
+    for kind, model in (('scheduled_messages', ScheduledMessage), ('scheduled_broadcasts', ScheduledBroadcast)):
+        due_count = session.query(func.count(model.id)).filter(
+            model.status == 'pending',
+            model.send_at <= now
+        ).scalar()
+        metrics.batch_backlog.set(due_count, kind=kind)
+    pending_chunks = session.query(func.count(DeliveryChunk.id)).filter(DeliveryChunk.status == 'pending').scalar()
+    metrics.batch_backlog.set(pending_chunks, kind='delivery_chunks')
+
 def main_loop():
+    pacer = SpreadPacer()
     while True:
         print(f"\n--- {datetime.now()} バッチ処理を開始 ---")
+        cycle_started = time.perf_counter()
+        cycle_result = 'ok'
         session = Session()
         try:
-            process_step_messages(session, line_bot_api)
-            process_scheduled_messages(session, line_bot_api)
+            record_backlog(session)
+            # アクセストークンは管理画面の設定を毎回参照する（Web側と同じ取得方法）
+            line_bot_api = get_line_bot_api(session)
+            if line_bot_api:
+                process_step_messages(session, line_bot_api)
+                process_scheduled_messages(session, line_bot_api)
+                process_scheduled_broadcasts(session, line_bot_api)
+            else:
+                print("!!! アクセストークンが設定されていないため、送信をスキップします。")
+            resumed = bulk_tags.resume_stale_jobs(session)
+            if resumed:
+                print(f"中断していたタグ一括更新を{resumed}件再開しました。")
+            purged = surveys.purge_expired_states(session)
+            if purged:
+                print(f"期限切れのアンケート回答待ちを{purged}件削除しました。")
+            broadcasts.purge_unused_payloads(session)
         except Exception as e:
             print(f"!!! バッチ処理中に予期せぬエラーが発生: {e}")
             session.rollback()
+            cycle_result = 'error'
         finally:
-            session.close()
-            print("--- バッチ処理終了 ---")
+            Session.remove()
+            cycle_seconds = time.perf_counter() - cycle_started
+            metrics.batch_cycle_seconds.observe(cycle_seconds, result=cycle_result)
+            metrics.batch_last_cycle_timestamp.set(time.time())
+            print(f"--- バッチ処理終了 ({cycle_seconds:.2f}秒) ---")
         
-        print("--- 60秒待機しています... ---")
-        time.sleep(60)
+        print(f"--- {BATCH_INTERVAL_SECONDS}秒待機しています（分散配信は{broadcasts.SPREAD_TICK_SECONDS}秒ごとに送信します）... ---")
+        next_cycle = time.monotonic() + BATCH_INTERVAL_SECONDS
+        while time.monotonic() < next_cycle:
+            time.sleep(min(broadcasts.SPREAD_TICK_SECONDS, max(0, next_cycle - time.monotonic())))
+            run_spread_tick(pacer)
 
 if __name__ == "__main__":
+    print("--- ステップ配信・予約投稿バッチ開始 ---")
+    if not get_database_url():
+        print("!!! エラー: 必要な環境変数が設定されていません。")
+        sys.exit(1)
+    try:
+        # 列・インデックスの追加はWebではなくバッチの起動時に1回だけ行う
+        migrate_schema(get_engine())
+    except Exception as e:
+        print(f"!!! データベース接続でエラー: {e}")
+        sys.exit(1)
+    # WORKER_METRICS_PORT を指定すると、バッチの /metrics を公開する（管理画面と同じBasic認証）
+    metrics_port = os.environ.get('WORKER_METRICS_PORT')
+    if metrics_port:
+        try:
+            metrics.serve_metrics(int(metrics_port), os.environ.get('ADMIN_USERNAME'), os.environ.get('ADMIN_PASSWORD'))
+            print(f"--- メトリクスを :{metrics_port}/metrics で公開しています ---")
+        except ValueError as e:
+            print(f"!!! メトリクスは公開しません: {e}")
     main_loop()
\ No newline at end of file
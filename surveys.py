@@ -0,0 +1,356 @@
+import atexit
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone, timedelta
+
+from sqlalchemy import insert, update, delete
+from sqlalchemy.exc import IntegrityError
+
+from core import Session, Setting, Tag, SurveyFlow, ConversationState, SurveyAnswer
+import bulk_tags
+import cache
+import metrics
+from recurrence import as_utc
+
+# --- アンケート（会話フロー）---
+# 管理画面で定義したフローを「開始キーワード」で始め、質問をクイックリプライで順に送る。
+# 回答待ちの状態は conversation_states（主キー = user_id、有効期限つき）に保存し、
+# プロセス内の LRU で読み込みを省く。回答とタグ付けは AnswerWriter がまとめて書き込む。
+STATE_TTL_MINUTES = int(os.environ.get('SURVEY_STATE_TTL_MINUTES', 60))
+STATE_CACHE_SIZE = int(os.environ.get('SURVEY_STATE_CACHE_SIZE', 10000))
+ANSWER_FLUSH_SECONDS = float(os.environ.get('SURVEY_ANSWER_FLUSH_SECONDS', 1.0))
+ANSWER_BATCH_SIZE = int(os.environ.get('SURVEY_ANSWER_BATCH_SIZE', 500))
+# クイックリプライの上限（ボタン13個・ラベル20文字）
+MAX_CHOICES = 13
+MAX_LABEL_LENGTH = 20
+
+# 以前の「アンケート」→「はい / いいえ」の動作を組み込みのフローとして一度だけ登録する
+DEFAULT_FLOW_SETTING_KEY = 'survey_default_flow_created'
+DEFAULT_FLOW = {
+    'name': '満足度アンケート',
+    'trigger_keyword': 'アンケート',
+    'questions': [{
+        'text': 'サービスに満足していますか？',
+        'choices': [{'label': 'はい', 'tag': 'satisfied'}, {'label': 'いいえ', 'tag': 'unsatisfied'}],
+    }],
+    'completion_message': 'ご回答ありがとうございます！ご回答を記録しました。',
+}
+
+survey_state_lookups = metrics.registry.register(metrics.Counter(
+    'linebot_survey_state_lookups_total', '回答待ち状態の参照回数（LRUのヒット / DB読み込み）', ('result',)))
+survey_answers_written = metrics.registry.register(metrics.Counter(
+    'linebot_survey_answers_written_total', '保存したアンケート回答の件数'))
+survey_answer_flushes = metrics.registry.register(metrics.Histogram(
+    'linebot_survey_answer_flush_duration_seconds', 'アンケート回答のまとめ書き込みにかかった時間'))
+
+
+class SurveyError(ValueError):
+    pass
+
+
+# --- フロー定義（管理画面の入力）---
+# 1行に1問、「質問文 | 選択肢=タグ | 選択肢」の形式（タグは省略可）
+def parse_questions(raw_text):
+    questions = []
+    for line_no, line in enumerate(raw_text.splitlines(), 1):
+        if not line.strip():
+            continue
+        parts = [part.strip() for part in line.split('|')]
+        text, choice_parts = parts[0], [part for part in parts[1:] if part]
+        if not text:
+            raise SurveyError(f"{line_no}行目に質問文がありません。")
+        if not choice_parts:
+            raise SurveyError(f"{line_no}行目に選択肢がありません。「質問文 | 選択肢=タグ | 選択肢」の形式で入力してください。")
+        if len(choice_parts) > MAX_CHOICES:
+            raise SurveyError(f"{line_no}行目の選択肢が多すぎます（最大{MAX_CHOICES}個）。")
+        choices = []
+        for part in choice_parts:
+            label, _, tag = part.partition('=')
+            label, tag = label.strip(), tag.strip()
+            if not label or len(label) > MAX_LABEL_LENGTH:
+                raise SurveyError(f"{line_no}行目の選択肢は1〜{MAX_LABEL_LENGTH}文字で入力してください。")
+            if ',' in tag:
+                raise SurveyError(f"{line_no}行目のタグ名にカンマは使えません。")
+            if any(choice['label'] == label for choice in choices):
+                raise SurveyError(f"{line_no}行目の選択肢「{label}」が重複しています。")
+            choices.append({'label': label, 'tag': tag or None})
+        questions.append({'text': text, 'choices': choices})
+    if not questions:
+        raise SurveyError("質問を1つ以上入力してください。")
+    return questions
+
+
+def flow_tags(questions):
+    return sorted({choice['tag'] for question in questions for choice in question['choices'] if choice['tag']})
+
+
+def create_flow(session, name, trigger_keyword, questions, completion_message):
+    if session.query(SurveyFlow).filter_by(trigger_keyword=trigger_keyword).first():
+        raise SurveyError(f"開始キーワード「{trigger_keyword}」は既に使われています。")
+    flow = SurveyFlow(
+        name=name, trigger_keyword=trigger_keyword,
+        questions=json.dumps(questions, ensure_ascii=False),
+        completion_message=completion_message, is_active=True
+    )
+    session.add(flow)
+    # 回答で付与するタグはタグ管理画面にも出るよう、先に登録しておく
+    tag_names = flow_tags(questions)
+    if tag_names:
+        existing = {name for (name,) in session.query(Tag.name).filter(Tag.name.in_(tag_names))}
+        session.add_all([Tag(name=name) for name in tag_names if name not in existing])
+    session.commit()
+    cache.invalidate(cache.SURVEY_FLOWS_KEY, cache.TAGS_KEY, cache.TAGS_PAGE_KEY)
+    return flow
+
+
+def ensure_default_flow(session):
+    if session.get(Setting, DEFAULT_FLOW_SETTING_KEY):
+        return
+    try:
+        if not session.query(SurveyFlow).filter_by(trigger_keyword=DEFAULT_FLOW['trigger_keyword']).first():
+            create_flow(session, **DEFAULT_FLOW)
+        session.add(Setting(key=DEFAULT_FLOW_SETTING_KEY, value='1'))
+        session.commit()
+    except IntegrityError:
+        # 別のワーカーが同時に登録した
+        session.rollback()
+
+
+def load_active_flows(session):
+    ensure_default_flow(session)
+    flows = session.query(SurveyFlow).filter(SurveyFlow.is_active == True).order_by(SurveyFlow.id)
+    return [{
+        'id': flow.id,
+        'trigger_keyword': flow.trigger_keyword,
+        'questions': json.loads(flow.questions),
+        'completion_message': flow.completion_message,
+    } for flow in flows]
+
+
+def get_active_flows(session):
+    return cache.get_or_load(cache.SURVEY_FLOWS_KEY, lambda: load_active_flows(session))
+
+
+# --- 回答待ちの状態 ---
+def _new_expiry():
+    return datetime.now(timezone.utc) + timedelta(minutes=STATE_TTL_MINUTES)
+
+
+class ConversationStateStore:
+    # 読み込みは LRU → テーブルの順。状態の更新は「読んだ時点の step」を条件にした UPDATE / DELETE で行い、
+    # 別のワーカーが先に進めていた場合（件数0）はキャッシュを捨てて読み直す。
+    def __init__(self, maxsize=STATE_CACHE_SIZE):
+        self._cache = cache.LRUCache(maxsize)
+
+    def get(self, session, user_id):
+        found, state = self._cache.get(user_id)
+        survey_state_lookups.inc(result='hit' if found else 'miss')
+        if found:
+            return state
+        row = session.get(ConversationState, user_id)
+        if row is None:
+            return None
+        remaining = (as_utc(row.expires_at) - datetime.now(timezone.utc)).total_seconds()
+        if remaining <= 0:
+            # 期限切れの行はバッチ（purge_expired_states）が削除する
+            return None
+        state = {'flow_id': row.flow_id, 'step': row.step}
+        self._cache.set(user_id, state, remaining)
+        return state
+
+    def start(self, session, user_id, flow_id):
+        session.merge(ConversationState(user_id=user_id, flow_id=flow_id, step=0, expires_at=_new_expiry()))
+        session.commit()
+        self._cache.set(user_id, {'flow_id': flow_id, 'step': 0}, STATE_TTL_MINUTES * 60)
+
+    def _matches(self, user_id, state):
+        return (
+            (ConversationState.user_id == user_id)
+            & (ConversationState.flow_id == state['flow_id'])
+            & (ConversationState.step == state['step'])
+        )
+
+    def advance(self, session, user_id, state, next_step):
+        result = session.execute(
+            update(ConversationState)
+            .where(self._matches(user_id, state))
+            .values(step=next_step, expires_at=_new_expiry())
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
+        if result.rowcount == 0:
+            self._cache.delete(user_id)
+            return False
+        self._cache.set(user_id, {'flow_id': state['flow_id'], 'step': next_step}, STATE_TTL_MINUTES * 60)
+        return True
+
+    def discard(self, user_id):
+        self._cache.delete(user_id)
+
+    def finish(self, session, user_id, state):
+        result = session.execute(
+            delete(ConversationState)
+            .where(self._matches(user_id, state))
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
+        self._cache.delete(user_id)
+        return result.rowcount > 0
+
+
+def purge_expired_states(session):
+    result = session.execute(
+        delete(ConversationState)
+        .where(ConversationState.expires_at < datetime.now(timezone.utc))
+        .execution_options(synchronize_session=False)
+    )
+    session.commit()
+    return result.rowcount
+
+
+# --- 回答のまとめ書き込み ---
+class AnswerWriter:
+    # 回答はメモリに溜め、ANSWER_FLUSH_SECONDS ごと（または ANSWER_BATCH_SIZE 件に達した時点）に
+    # 1回の executemany と、タグごとの UPDATE（bulk_tags.apply_chunk）で反映する
+    def __init__(self, flush_seconds=ANSWER_FLUSH_SECONDS, batch_size=ANSWER_BATCH_SIZE):
+        self.flush_seconds = flush_seconds
+        self.batch_size = batch_size
+        self._rows = []
+        self._tag_records = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def add(self, flow_id, user_id, question_index, answer, tag=None):
+        with self._lock:
+            self._rows.append({
+                'flow_id': flow_id,
+                'user_id': user_id,
+                'question_index': question_index,
+                'answer': answer,
+                'created_at': datetime.now(timezone.utc),
+            })
+            if tag:
+                self._tag_records.append((user_id, (tag,), ()))
+            if self._thread is None:
+                # gunicorn の preload 後（ワーカー内）で初めて使われた時にスレッドを起動する
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            full = len(self._rows) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def pending(self):
+        with self._lock:
+            return len(self._rows)
+
+    def flush(self, session):
+        with self._lock:
+            rows, tag_records = self._rows, self._tag_records
+            self._rows, self._tag_records = [], []
+        if not rows:
+            return 0
+        started = time.perf_counter()
+        try:
+            session.execute(insert(SurveyAnswer.__table__), rows)
+            if tag_records:
+                bulk_tags.apply_chunk(session, tag_records)
+            else:
+                session.commit()
+        except Exception as e:
+            session.rollback()
+            print(f"!!! アンケート回答の保存でエラー（{len(rows)}件を破棄）: {e}")
+            return 0
+        survey_answer_flushes.observe(time.perf_counter() - started)
+        survey_answers_written.inc(len(rows))
+        return len(rows)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_seconds)
+            self._wakeup.clear()
+            try:
+                self.flush(Session())
+            finally:
+                Session.remove()
+
+
+state_store = ConversationStateStore()
+answer_writer = AnswerWriter()
+
+
+@atexit.register
+def flush_pending_answers():
+    if not answer_writer.pending():
+        return
+    try:
+        answer_writer.flush(Session())
+    finally:
+        Session.remove()
+
+
+# --- 受信メッセージの処理 ---
+def _question_message(question):
+    from linebot.models import TextSendMessage, QuickReply, QuickReplyButton, MessageAction
+    buttons = [
+        QuickReplyButton(action=MessageAction(label=choice['label'], text=choice['label']))
+        for choice in question['choices']
+    ]
+    return TextSendMessage(text=question['text'], quick_reply=QuickReply(items=buttons))
+
+
+def _is_choice_label(flows, text):
+    return any(
+        choice['label'] == text
+        for flow in flows for question in flow['questions'] for choice in question['choices']
+    )
+
+
+def handle_text(session, user_id, text):
+    # アンケートとして処理した場合は返信するメッセージのリストを、関係ないメッセージなら None を返す
+    flows = get_active_flows(session)
+    for flow in flows:
+        if flow['trigger_keyword'] == text:
+            state_store.start(session, user_id, flow['id'])
+            return [_question_message(flow['questions'][0])]
+
+    # どの選択肢とも一致しない発言では状態を読まない
+    if not _is_choice_label(flows, text):
+        return None
+
+    from linebot.models import TextSendMessage
+    for attempt in range(2):
+        state = state_store.get(session, user_id)
+        if state is None:
+            return None
+        flow = next((f for f in flows if f['id'] == state['flow_id']), None)
+        if flow is None or state['step'] >= len(flow['questions']):
+            # フローが削除・停止された（キャッシュが古いだけなら読み直す）
+            if state_store.finish(session, user_id, state) or attempt:
+                return None
+            continue
+        question = flow['questions'][state['step']]
+        choice = next((c for c in question['choices'] if c['label'] == text), None)
+        if choice is None:
+            if attempt == 0:
+                # キャッシュが古い可能性があるので、テーブルから読み直して確かめる
+                state_store.discard(user_id)
+                continue
+            return [_question_message(question)]
+
+        next_step = state['step'] + 1
+        if next_step < len(flow['questions']):
+            moved = state_store.advance(session, user_id, state, next_step)
+        else:
+            moved = state_store.finish(session, user_id, state)
+        if not moved:
+            # 別のワーカーが先に状態を進めていたので、読み直してもう一度だけ処理する
+            continue
+
+        answer_writer.add(flow['id'], user_id, state['step'], choice['label'], choice['tag'])
+        if next_step < len(flow['questions']):
+            return [_question_message(flow['questions'][next_step])]
+        return [TextSendMessage(text=flow['completion_message'])]
+    return None